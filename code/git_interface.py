@@ -1,5 +1,5 @@
 from util import *
-import os, sys, subprocess
+import array, bisect, collections, heapq, mmap, os, struct, sys, subprocess, zlib
 
 def reset_all_to_master(code_dir):
   print code_dir
@@ -101,6 +101,45 @@ def git_checkout(commit, orig_dir, git_name=None,target_dir=None, prefix=None):
     call_cmd(cp_cmd)
   return target_commit_dir
     
+"""
+Writes the code files of a commit into
+  target_dir/<prefix>_<commit timestamp>_<commit hash>
+reading blobs through a GitObjectReader, so the student's
+work tree is never checked out or copied.
+
+match_fn(fname) selects which top-level files are exported.
+Returns (snapshot dir, list of (file name, blob hash) exported).
+If the snapshot dir already exists, nothing is written but the
+file list is still returned.
+Expected commit format: %h %ct <commit short hash> <unix timestamp>
+"""
+def git_export(commit, reader, target_dir, prefix=None, match_fn=None):
+  commit_hash, _ = commit.split(' ')
+  target_commit_dir = os.path.join(target_dir, snapshot_name(prefix, commit))
+  files = [(fname, blob_hash) \
+      for fname, blob_hash in reader.list_files(commit_hash) \
+      if not match_fn or match_fn(fname)]
+  if os.path.exists(target_commit_dir):
+    return target_commit_dir, files
+  os.makedirs(target_commit_dir)
+
+  for fname, blob_hash in files:
+    with open(os.path.join(target_commit_dir, fname), 'wb') as f:
+      f.write(reader.read_blob(blob_hash))
+  return target_commit_dir, files
+
+"""
+Name of a commit's snapshot, <prefix>_<commit timestamp>_<commit hash>,
+and the commit ("hash timestamp") of a snapshot name.
+"""
+def snapshot_name(prefix, commit):
+  commit_hash, posix_time = commit.split(' ')
+  return "%s_%s_%s" % (prefix, posix_time, commit_hash)
+
+def snapshot_commit(snapshot):
+  _, posix_time, commit_hash = snapshot.rsplit('_', 2)
+  return "%s %s" % (commit_hash, posix_time)
+
 """
 Gets latest snapshot (the last one that the student submitted).
 """
@@ -115,3 +154,448 @@ def git_master(orig_dir, git_name=None):
   out, master_cmd_err = call_cmd(master_cmd)
   if 'error' in master_cmd_err:
     print "master: ignoring %s, corrupt git" % (orig_dir.split('/')[-1])
+
+############### object database #####################
+GIT_FILE_MODES = ('100644', '100755')
+GIT_ABBREV = 7              # minimum abbreviated hash length, as git's
+GIT_CACHE_SIZE = 32 * 2**20 # bytes of inflated objects cached per reader
+
+"""
+Opens a reader of a repository's object database (see GIT_READERS):
+  python:     GitRepoReader, in-process (default)
+  subprocess: GitObjectReader, through `git cat-file --batch`
+"""
+def open_reader(orig_dir, kind='python', git_name=None):
+  return GIT_READERS[kind](orig_dir, git_name)
+
+"""
+Operations shared by the object database readers, on top of
+read_object(hash) -> (type, raw contents).
+"""
+class _GitReader(object):
+  def commit_tree(self, commit_hash):
+    obj_type, data = self.read_object(commit_hash)
+    if obj_type != 'commit':
+      return None
+    return data.split('\n', 1)[0].split(' ')[1] # "tree <hash>"
+
+  """
+  Returns a list of (mode, name, hash) for the top level of a commit's tree.
+  """
+  def list_tree(self, commit_hash):
+    tree_hash = self.commit_tree(commit_hash)
+    if not tree_hash:
+      return []
+    _, data = self.read_object(tree_hash)
+    entries = []
+    i = 0
+    while i < len(data):
+      space = data.index(' ', i)
+      nul = data.index('\0', space)
+      entries.append((data[i:space], data[space+1:nul],
+                      data[nul+1:nul+21].encode('hex')))
+      i = nul + 21
+    return entries
+
+  """
+  Returns a list of (name, blob hash) for the regular top-level files.
+  """
+  def list_files(self, commit_hash):
+    return [(name, obj_hash) \
+        for mode, name, obj_hash in self.list_tree(commit_hash) \
+        if mode in GIT_FILE_MODES]
+
+  def read_blob(self, blob_hash):
+    return self.read_object(blob_hash)[1]
+
+"""
+Reads objects straight from a repository's object database
+through one long-lived `git cat-file --batch` process.
+
+One reader per student repository; call close() when done.
+"""
+class GitObjectReader(_GitReader):
+  def __init__(self, orig_dir, git_name=None):
+    if not git_name:
+      git_name = ".git"
+    self.orig_dir = orig_dir
+    self.git_dir = os.path.join(orig_dir, git_name)
+    self.proc = subprocess.Popen(
+        ["git", "--git-dir=%s" % self.git_dir, "cat-file", "--batch"],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+  """
+  Returns (type, raw contents) of an object, or (None, None) if missing.
+  """
+  def read_object(self, obj_hash):
+    self.proc.stdin.write(obj_hash + '\n')
+    self.proc.stdin.flush()
+    header = self.proc.stdout.readline().split()
+    if len(header) != 3: # "<hash> missing"
+      return None, None
+    _, obj_type, size = header
+    data = self.proc.stdout.read(int(size))
+    self.proc.stdout.read(1) # trailing newline
+    return obj_type, data
+
+  """
+  Returns the object hash a revision (e.g. "master") points to, or None.
+  """
+  def resolve(self, rev):
+    self.proc.stdin.write(rev + '\n')
+    self.proc.stdin.flush()
+    header = self.proc.stdout.readline().split()
+    if len(header) != 3:
+      return None
+    self.proc.stdout.read(int(header[2]) + 1) # contents and newline
+    return header[0]
+
+  """
+  Returns the commits reachable from HEAD as "hash timestamp"
+  (abbreviated hash, committer time) strings, newest first.
+  exclude: full hash of a commit whose history is left out (`exclude..HEAD`)
+  """
+  def list_commits(self, exclude=None):
+    log = git_log(git_dir=self.orig_dir, format_str="%h %ct",
+                  extra_str="%s..HEAD" % exclude if exclude else None)
+    return [commit for commit in log.split('\n') if commit]
+
+  def close(self):
+    if self.proc.poll() is None:
+      self.proc.stdin.close()
+      self.proc.wait()
+
+"""
+Reads loose objects and pack files (idx v2) of a repository in-process,
+resolving deltas, so that listing and exporting snapshots needs no git
+subprocess. Inflated objects are kept in an LRU cache of GIT_CACHE_SIZE
+bytes (delta chains share their bases).
+
+Same operations as GitObjectReader; call close() when done.
+"""
+class GitRepoReader(_GitReader):
+  OBJ_TYPES = {1: 'commit', 2: 'tree', 3: 'blob', 4: 'tag'}
+  OFS_DELTA, REF_DELTA = 6, 7
+
+  def __init__(self, orig_dir, git_name=None):
+    if not git_name:
+      git_name = ".git"
+    self.git_dir = os.path.join(orig_dir, git_name)
+    self.objects_dir = os.path.join(self.git_dir, 'objects')
+    self.packs = [] # (sorted binary hashes, offsets, pack mmap)
+    self.cache = collections.OrderedDict() # key -> (type, data)
+    self.cache_size = 0
+    self.names = None # sorted hex hashes of all objects, for abbreviations
+    self.shallow = None # boundary commits of a shallow clone
+    pack_dir = os.path.join(self.objects_dir, 'pack')
+    if os.path.isdir(pack_dir):
+      for fname in sorted(os.listdir(pack_dir)):
+        if fname.endswith('.idx'):
+          self.packs.append(self._open_pack(os.path.join(pack_dir, fname)))
+
+  """
+  Returns (type, raw contents) of an object, or (None, None) if missing.
+  """
+  def read_object(self, obj_hash):
+    if len(obj_hash) != 40:
+      obj_hash = self.resolve(obj_hash)
+      if not obj_hash:
+        return None, None
+    cached = self._cache_get(obj_hash)
+    if cached:
+      return cached
+    obj = self._read_loose(obj_hash)
+    if not obj:
+      binary = obj_hash.decode('hex')
+      for pack in self.packs:
+        offset = self._find_in_pack(pack, binary)
+        if offset is not None:
+          obj = self._read_packed(pack, offset)
+          break
+    if not obj:
+      return None, None
+    self._cache_put(obj_hash, obj)
+    return obj
+
+  """
+  Returns the object hash a revision (a full or abbreviated hash,
+  HEAD, a branch or a ref) points to, or None.
+  """
+  def resolve(self, rev):
+    for ref in (rev, 'refs/' + rev, 'refs/heads/' + rev, 'refs/tags/' + rev):
+      obj_hash = self._read_ref(ref)
+      if obj_hash:
+        return obj_hash
+    if 4 <= len(rev) <= 40 and all(c in '0123456789abcdef' for c in rev):
+      names = self._get_names()
+      i = bisect.bisect_left(names, rev)
+      if i < len(names) and names[i].startswith(rev) and \
+          (i + 1 == len(names) or not names[i+1].startswith(rev)):
+        return names[i]
+    return None
+
+  """
+  Returns the commits reachable from HEAD as "hash timestamp"
+  (abbreviated hash, committer time) strings, newest first,
+  walked in the same order as `git log`.
+  exclude: full hash of a commit whose history is left out (`exclude..HEAD`)
+  """
+  def list_commits(self, exclude=None):
+    head = self.resolve('HEAD')
+    if not head or not self._commit_headers(head):
+      return []
+    seen = set()
+    if exclude:
+      stack = [exclude]
+      while stack:
+        commit_hash = stack.pop()
+        if commit_hash in seen: continue
+        seen.add(commit_hash)
+        stack.extend(self._commit_parents(commit_hash))
+      if head in seen:
+        return []
+    commits = []
+    seen.add(head)
+    queue = [] # (-committer time, insertion order, hash)
+    heapq.heappush(queue, (-self._commit_time(head), 0, head))
+    n = 1
+    while queue:
+      neg_time, _, commit_hash = heapq.heappop(queue)
+      commits.append('%s %d' % (self._abbrev(commit_hash), -neg_time))
+      for parent in self._commit_parents(commit_hash):
+        if parent in seen: continue
+        seen.add(parent)
+        heapq.heappush(queue, (-self._commit_time(parent), n, parent))
+        n += 1
+    return commits
+
+  def close(self):
+    for _, _, data in self.packs:
+      data.close()
+    self.packs = []
+    self.cache.clear()
+    self.cache_size = 0
+
+  ##### commits
+  def _commit_headers(self, commit_hash):
+    obj_type, data = self.read_object(commit_hash)
+    if obj_type != 'commit':
+      return []
+    return data.split('\n\n', 1)[0].split('\n')
+
+  """
+  Parents of a commit that are in the repository. Like git, the walk
+  stops at the commits of a shallow clone's boundary (.git/shallow)
+  and at parents missing from the object database.
+  """
+  def _commit_parents(self, commit_hash):
+    if commit_hash in self._get_shallow():
+      return []
+    return [line[7:] for line in self._commit_headers(commit_hash) \
+        if line.startswith('parent ') and self._commit_headers(line[7:])]
+
+  def _get_shallow(self):
+    if self.shallow is None:
+      self.shallow = set()
+      path = os.path.join(self.git_dir, 'shallow')
+      if os.path.isfile(path):
+        with open(path) as f:
+          self.shallow = set(line.strip() for line in f if line.strip())
+    return self.shallow
+
+  def _commit_time(self, commit_hash):
+    for line in self._commit_headers(commit_hash):
+      if line.startswith('committer '):
+        return int(line.rsplit(' ', 2)[1])
+    return 0
+
+  """
+  Shortest unique prefix of at least GIT_ABBREV characters, growing
+  with the number of packed objects like git's default (core.abbrev=auto,
+  which estimates the object count from the packs only).
+  """
+  def _abbrev(self, obj_hash):
+    names = self._get_names()
+    num_packed = sum(len(offsets) for _, offsets, _ in self.packs)
+    length = max(GIT_ABBREV, (num_packed.bit_length() + 1) // 2)
+    i = bisect.bisect_left(names, obj_hash)
+    for neighbor in names[max(i-1, 0):i] + names[i+1:i+2]:
+      common = 0
+      while common < 40 and neighbor[common] == obj_hash[common]:
+        common += 1
+      length = max(length, common + 1)
+    return obj_hash[:length]
+
+  def _get_names(self):
+    if self.names is None:
+      names = set()
+      for hashes, _, _ in self.packs:
+        names.update(hashes[i:i+20].encode('hex') \
+            for i in range(0, len(hashes), 20))
+      if os.path.isdir(self.objects_dir):
+        for prefix in os.listdir(self.objects_dir):
+          if len(prefix) != 2: continue
+          names.update(prefix + rest for rest in \
+              os.listdir(os.path.join(self.objects_dir, prefix)))
+      self.names = sorted(names)
+    return self.names
+
+  ##### refs
+  def _read_ref(self, ref, depth=0):
+    path = os.path.join(self.git_dir, ref)
+    if ref != 'HEAD' and not ref.startswith('refs/'):
+      return None
+    if os.path.isfile(path):
+      with open(path) as f:
+        value = f.read().strip()
+      if value.startswith('ref: '):
+        return self._read_ref(value[5:], depth + 1) if depth < 5 else None
+      return value
+    packed_refs = os.path.join(self.git_dir, 'packed-refs')
+    if os.path.isfile(packed_refs):
+      with open(packed_refs) as f:
+        for line in f:
+          if line.startswith('#') or line.startswith('^'): continue
+          parts = line.split()
+          if len(parts) == 2 and parts[1] == ref:
+            return parts[0]
+    return None
+
+  ##### loose objects
+  def _read_loose(self, obj_hash):
+    path = os.path.join(self.objects_dir, obj_hash[:2], obj_hash[2:])
+    if not os.path.isfile(path):
+      return None
+    with open(path, 'rb') as f:
+      raw = zlib.decompress(f.read())
+    header, data = raw.split('\0', 1)
+    return header.split(' ')[0], data
+
+  ##### pack files
+  def _open_pack(self, idx_path):
+    with open(idx_path, 'rb') as f:
+      idx = f.read()
+    assert idx[:8] == '\377tOc\0\0\0\2', "unsupported pack index: " + idx_path
+    count = struct.unpack('>I', idx[8 + 255*4:8 + 256*4])[0]
+    hashes_start = 8 + 256*4
+    offsets_start = hashes_start + count*24 # after hashes and crc32s
+    hashes = idx[hashes_start:hashes_start + count*20]
+    offsets = array.array('L', [])
+    large_start = offsets_start + count*4
+    for (offset,) in (struct.unpack_from('>I', idx, offsets_start + i*4) \
+        for i in range(count)):
+      if offset & 0x80000000: # index into the 8-byte offsets
+        offset = struct.unpack_from('>Q', idx,
+            large_start + (offset & 0x7fffffff)*8)[0]
+      offsets.append(offset)
+    with open(idx_path[:-4] + '.pack', 'rb') as f:
+      data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return hashes, offsets, data
+
+  def _find_in_pack(self, pack, binary):
+    hashes, offsets, _ = pack
+    lo, hi = 0, len(offsets)
+    while lo < hi:
+      mid = (lo + hi) // 2
+      mid_hash = hashes[mid*20:mid*20 + 20]
+      if mid_hash < binary: lo = mid + 1
+      elif mid_hash > binary: hi = mid
+      else: return offsets[mid]
+    return None
+
+  def _read_packed(self, pack, offset):
+    key = (id(pack), offset)
+    cached = self._cache_get(key)
+    if cached:
+      return cached
+    data = pack[2]
+    pos = offset
+    byte = ord(data[pos])
+    obj_type = (byte >> 4) & 7
+    size = byte & 0x0f
+    shift = 4
+    while byte & 0x80:
+      pos += 1
+      byte = ord(data[pos])
+      size |= (byte & 0x7f) << shift
+      shift += 7
+    pos += 1
+    if obj_type == self.OFS_DELTA:
+      byte = ord(data[pos])
+      base_offset = byte & 0x7f
+      while byte & 0x80:
+        pos += 1
+        byte = ord(data[pos])
+        base_offset = ((base_offset + 1) << 7) | (byte & 0x7f)
+      pos += 1
+      base_type, base = self._read_packed(pack, offset - base_offset)
+      obj = base_type, self._apply_delta(base, self._inflate(data, pos, size))
+    elif obj_type == self.REF_DELTA:
+      base_type, base = self.read_object(data[pos:pos+20].encode('hex'))
+      obj = base_type, self._apply_delta(base, self._inflate(data, pos + 20, size))
+    else:
+      obj = self.OBJ_TYPES[obj_type], self._inflate(data, pos, size)
+    self._cache_put(key, obj)
+    return obj
+
+  """
+  Inflates the zlib stream at pos, up to the size given in its header.
+  """
+  def _inflate(self, data, pos, size):
+    inflater = zlib.decompressobj()
+    out = []
+    length = 0
+    chunk = size + 64 # compressed size is usually smaller
+    while length < size and pos < len(data):
+      piece = inflater.decompress(data[pos:pos + chunk])
+      pos += chunk
+      out.append(piece)
+      length += len(piece)
+    return ''.join(out)
+
+  def _apply_delta(self, base, delta):
+    pos = 0
+    for _ in range(2): # source and target sizes
+      while ord(delta[pos]) & 0x80:
+        pos += 1
+      pos += 1
+    out = []
+    while pos < len(delta):
+      op = ord(delta[pos])
+      pos += 1
+      if op & 0x80: # copy from base
+        offset = size = 0
+        for i in range(4):
+          if op & (1 << i):
+            offset |= ord(delta[pos]) << (8 * i)
+            pos += 1
+        for i in range(3):
+          if op & (0x10 << i):
+            size |= ord(delta[pos]) << (8 * i)
+            pos += 1
+        out.append(base[offset:offset + (size or 0x10000)])
+      elif op: # insert
+        out.append(delta[pos:pos + op])
+        pos += op
+      else:
+        raise ValueError("invalid delta opcode")
+    return ''.join(out)
+
+  ##### cache
+  def _cache_get(self, key):
+    obj = self.cache.pop(key, None)
+    if obj:
+      self.cache[key] = obj
+    return obj
+
+  def _cache_put(self, key, obj):
+    if len(obj[1]) > GIT_CACHE_SIZE:
+      return
+    if key in self.cache:
+      self.cache_size -= len(self.cache.pop(key)[1])
+    self.cache[key] = obj
+    self.cache_size += len(obj[1])
+    while self.cache_size > GIT_CACHE_SIZE:
+      self.cache_size -= len(self.cache.popitem(last=False)[1][1])
+
+GIT_READERS = {'python': GitRepoReader, 'subprocess': GitObjectReader}
@@ -1,5 +1,5 @@
 from util import *
-import os
+import os, fnmatch, hashlib
 import pymoss
 
 
@@ -26,52 +26,177 @@ TYPE_STR = ["STARTER", "CURRENT", "ARCHIVE"]
 ##### TMOSS interface function
 def compute_similarity(snapshot_dir, archives, student, args):
   snapshot = os.path.basename(os.path.normpath(snapshot_dir))
-  snapshot_dir = os.path.realpath(snapshot_dir)
-  filelang = args.extension
-  final_submissions_dir, online_dir = archives
+  return compute_similarity_batch([(snapshot_dir, student)],
+          archives, args)[snapshot]
 
-  runner = make_moss_runner(filelang, snapshot_dir,
-          final_submissions_dir, online_dir,
-          args.starter)
+"""
+Runs many snapshots (from one student or several) in a single backend
+invocation against one copy of the archive. Each file of a snapshot is
+ranked on its own (see Result.get_file), so per-file results can be reused.
+skip: snapshot name -> code dirs of the snapshot to leave out.
+Returns a dictionary of snapshot name -> list of results.
+"""
+def compute_similarity_batch(snapshots, archives, args, skip=None):
+  snapshot_dirs = [os.path.realpath(snapshot_dir) \
+          for snapshot_dir, _ in snapshots]
+  filelang = args.extension
+  archive = get_archive(filelang, archives, args)
 
-  output_temp_dir = os.path.join(args.temp, 'moss_%s' % snapshot)
+  output_temp_dir = get_similarity_workspace(snapshot_dirs[0], args)
   if os.path.exists(output_temp_dir):
     shutil.rmtree(output_temp_dir)
-  gen_moss_output(runner, snapshot, output_temp_dir)
-  return make_results(student.get_name(), runner, snapshot, args)
+  # keep: the runner works in output_temp_dir directly, nothing is copied
+  runner_dir = output_temp_dir if args.moss_output == 'keep' else None
+  runner = make_moss_runner(filelang, snapshot_dirs, archive, args.starter,
+          tmpdir=runner_dir, backend=args.backend,
+          index=get_index(archive, args), prefilter=args.prefilter, skip=skip)
 
-def cleanup_similarity_workspace(snapshot_dir, args):
+  results = {}
+  if not runner.counts[pymoss.util.ARCHIVE]:
+    # pre-filter found nothing in the archive: no backend run needed
+    for snapshot_dir, student in snapshots:
+      snapshot = os.path.basename(os.path.normpath(snapshot_dir))
+      results[snapshot] = [Result(student.get_name(), snapshot)]
+    runner.cleanup()
+    return results
+
+  desc = os.path.basename(snapshot_dirs[0])
+  if len(snapshot_dirs) > 1:
+    desc = "%s (+%d)" % (desc, len(snapshot_dirs) - 1)
+  if runner_dir:
+    gen_moss_output(runner, desc)
+  else:
+    gen_moss_output(runner, desc, output_temp_dir, args.moss_output)
+    runner.cleanup() # reports read from output_temp_dir from now on
+  for snapshot_dir, student in snapshots:
+    snapshot = os.path.basename(os.path.normpath(snapshot_dir))
+    results[snapshot] = make_results(student.get_name(), runner, snapshot)
+  return results
+
+"""
+Returns the serialized archive (final submissions + online) for a
+compare set. Built or validated once per course by prepare_archive,
+before workers fork; workers reuse it without touching its files.
+"""
+_archives = {}
+def get_archive(filelang, archives, args):
+  key = (filelang,) + tuple(archives)
+  if key not in _archives:
+    prepare_archive(filelang, archives, args)
+  return _archives[key]
+
+"""
+Serializes the archive of a compare set, unless its serialized copy is
+up to date, and brings its fingerprint index (if any) up to date.
+"""
+def prepare_archive(filelang, archives, args):
+  final_submissions_dir, online_dir = archives
+  key = (filelang,) + tuple(archives)
+  if key not in _archives:
+    # kept across runs, so an unchanged archive is not serialized again
+    archive = pymoss.Archive(filelang,
+        get_cache_dir(archives, 'archive', filelang))
+    archive.add_all(final_submissions_dir)
+    if os.path.exists(online_dir):
+      archive.add_all(online_dir)
+    _archives[key] = archive
+  archive = _archives[key]
+  archive.build()
+  if args.prefilter:
+    if archive.dir not in _indexes:
+      _indexes[archive.dir] = pymoss.FingerprintIndex(
+          get_cache_dir(archives, 'index', filelang))
+    _indexes[archive.dir].update(archive) # no-op if the archive did not change
+  return archive
+
+"""
+Returns the fingerprint index of an archive (None if --prefilter is off),
+opened and updated by prepare_archive.
+"""
+_indexes = {}
+def get_index(archive, args):
+  if not args.prefilter:
+    return None
+  return _indexes[archive.dir]
+
+"""
+Directory of compare set data that is reused by later runs, next to the
+final submissions: the temp workspace is removed after every course.
+"""
+def get_cache_dir(archives, name, filelang):
+  final_submissions_dir, _ = archives
+  return '%s_%s_%s' % (os.path.normpath(final_submissions_dir), name, filelang)
+
+"""
+Workspace of a backend run, named after the (first) snapshot in it.
+"""
+def get_similarity_workspace(snapshot_dir, args):
   snapshot = os.path.basename(os.path.normpath(snapshot_dir))
-  output_temp_dir = os.path.join(args.temp, 'moss_%s' % snapshot)
+  return os.path.join(args.temp, 'moss_%s' % snapshot)
+
+def cleanup_similarity_workspace(snapshot_dir, args):
+  output_temp_dir = get_similarity_workspace(snapshot_dir, args)
   if os.path.exists(output_temp_dir):
     shutil.rmtree(output_temp_dir)
 
+"""
+Content key of a snapshot: a hash over the (name, blob hash) of every
+file the backend would read. Snapshots with equal keys score the same.
+"""
+def snapshot_key(files, filelang):
+  patterns = MATCH_FILES[filelang]
+  matched = sorted((fname, blob_hash) for fname, blob_hash in files \
+      if any(fnmatch.fnmatch(fname, pat) for pat in patterns))
+  return hashlib.sha1(repr(matched)).hexdigest()
+
 ##### Helper functions
-def make_results(student, runner, snapshot, args):
-  # ignore all self ones
-  results = [MossResult(pair, runner, snapshot, args) \
-          for pair in runner.pairs if not pair.is_self]
+def make_results(student, runner, snapshot):
+  # ignore all self ones, and other snapshots in the same batch
+  results = [MossResult(pair, runner, snapshot) \
+          for pair in runner.pairs \
+          if not pair.is_self and \
+            os.path.dirname(pair.submits[0].batch) == snapshot]
   if not results:
     results = [Result(student, snapshot)] # empty result
   return results
 
-def make_moss_runner(filelang, snapshot_dir,
-    final_submissions_dir, online_dir, starter_dir):
-  snapshot = os.path.basename(os.path.normpath(snapshot_dir))
-  m = pymoss.Runner(filelang, THRESHOLD)
+"""
+Every code dir of a snapshot is its own batch, so its top pairs are kept
+whichever file scores best. Code dirs in skip[snapshot] are left out.
+
+With an index, only the top `prefilter` archive submissions per snapshot
+file (by shared fingerprints) are attached to the runner, leaving out the
+file's own student.
+"""
+def make_moss_runner(filelang, snapshot_dirs, archive, starter_dir,
+    tmpdir=None, backend=None, index=None, prefilter=0, skip=None):
+  m = pymoss.Runner(filelang, THRESHOLD, tmpdir, backend)
   if os.path.exists(starter_dir):
     m.add(starter_dir, pymoss.util.STARTER)
-  m.add_all(snapshot_dir, prefix=snapshot)
-  m.add_all(final_submissions_dir, pymoss.util.ARCHIVE)
-  if os.path.exists(online_dir):
-    m.add_all(online_dir, pymoss.util.ARCHIVE)
+  for snapshot_dir in snapshot_dirs:
+    snapshot = os.path.basename(os.path.normpath(snapshot_dir))
+    skip_dirs = skip.get(snapshot, ()) if skip else ()
+    for code_dirname in sorted(os.listdir(snapshot_dir)):
+      code_dir = os.path.join(snapshot_dir, code_dirname)
+      if code_dirname in skip_dirs or not os.path.isdir(code_dir): continue
+      name = os.path.join(snapshot, code_dirname)
+      m.add(code_dir, name=name, batch=name)
+  names = None
+  if index:
+    names = set()
+    for s in m.submits.values():
+      if s.type != pymoss.util.CURRENT: continue
+      names.update(index.candidates(s.tmpfile(m.tmpdir), filelang, prefilter,
+          s.student()))
+  m.attach(archive, names)
   return m
 
-def gen_moss_output(moss_runner, snapshot, output_temp_dir):
+def gen_moss_output(moss_runner, snapshot, output_temp_dir=None,
+    output=pymoss.config.OUTPUT):
   print "--- Running MOSS on", snapshot
-  if os.path.exists(output_temp_dir):
+  if output_temp_dir and os.path.exists(output_temp_dir):
     shutil.rmtree(output_temp_dir)
-  moss_runner.run(output_temp_dir)
+  moss_runner.run(output_temp_dir, output=output)
   print
 
 ##### TMOSS Result object
@@ -80,35 +205,66 @@ Results will be saved for each quarter.
 out/
   2012_1/
     top_matches.csv # student,token,timestamp,snapshot_num
+    results.db      # all snapshot results (see store.py)
     student/
       top_match_html
-      student_matches.csv
-"""
-class MossResult(pymoss.Pair, Result):
-  def __init__(self, pair, runner, snapshot, args):
-    # copied from Pair in code/pymoss/util.py
-    for k, v in pair.__dict__.iteritems():
-      self.__dict__[k] = v
-
-    self.student = self.submits[0].student()
-    self.other = self.submits[1].student()
-    self.runner = runner
-    self.args = args
-    self.snapshot = snapshot
-    """
-    Score:
-      self.match:   matched token count
-      self.common:  matched "common" tokens (including starter code)
-      self.percent: (% snapshot, % similarity)
-    """
-    self.score = self.tokens.match
-    
-  def write_html(self, out_dir):
-    if not os.path.exists(out_dir):
-      os.makedirs(out_dir)
-    fdest = os.path.join(out_dir, "{}.html".format(self.get_snapshot()))
-    if os.path.exists(fdest):
-      os.remove(fdest)
-    h = pymoss.Html(self.runner, self.get_snapshot())
-    h.gen_report(self, fdest)
-    print "--- Writing MOSS HTML to", fdest
+"""
+class MossResult(Result):
+  __slots__ = ('pair', 'lang', 'reportdir')
+
+  """
+  Keeps the pair (not the runner) and where its submissions were read from,
+  until the report is saved (see Student.record_files).
+  Score:
+    pair.tokens.match:  matched token count
+    pair.tokens.common: matched "common" tokens (including starter code)
+    pair.percent:       (% snapshot, % similarity)
+  """
+  def __init__(self, pair, runner, snapshot):
+    Result.__init__(self, pair.submits[0].student(), snapshot,
+                    pair.tokens.match, pair.submits[1].student())
+    self.pair = pair
+    self.lang = runner.lang
+    self.reportdir = runner.reportdir
+
+  """
+  Everything needed to render this result's report later without the
+  runner: the pair's state and the contents of both submissions.
+  """
+  def get_report(self):
+    sources = []
+    for submit in self.pair.submits:
+      with open(submit.tmpfile(self.reportdir)) as f:
+        sources.append(f.read())
+    return {'lang': self.lang, 'pair': self.pair.get_state(),
+            'sources': sources}
+
+  def get_file(self):
+    return os.path.basename(self.pair.submits[0].name)
+
+"""
+Renders a report saved by MossResult.get_report to out_dir/<snapshot>.html,
+or out_dir/<snapshot>.html.gz if compressed.
+If assets_dir is given, the report links to static files written there once
+instead of inlining them.
+"""
+def write_report(report, snapshot, out_dir, assets_dir=None, compress=False):
+  if not os.path.exists(out_dir):
+    os.makedirs(out_dir)
+  fdest = os.path.join(out_dir, "{}.html".format(snapshot))
+  if compress:
+    fdest += ".gz"
+  if os.path.exists(fdest):
+    os.remove(fdest)
+  assets = None
+  if assets_dir:
+    pymoss.Html.write_assets(assets_dir)
+    assets = os.path.relpath(assets_dir, out_dir)
+  pair = pymoss.Pair.from_state(report['pair'])
+  sources = dict((submit.name, source) \
+      for submit, source in zip(pair.submits, report['sources']))
+  h = pymoss.Html(desc=snapshot, lang=report['lang'], sources=sources,
+                  assets=assets)
+  h.gen_report(pair, fdest)
+  print "--- Writing MOSS HTML to", fdest
+  return fdest
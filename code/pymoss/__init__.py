@@ -9,9 +9,11 @@ This package provides Python bindings to interact with the MOSS binary.
 import os, sys
 sys.path.insert(1, os.path.realpath(os.path.join(os.path.dirname(__file__), "lib")))
 
-__all__ = ["config", "html", "runner", "util"]
-from . import config
+__all__ = ["archive", "backend", "command", "config", "html", "index", "runner", "util"]
+from . import backend, command, config
+from .archive import Archive
 from .html import Html
+from .index import FingerprintIndex
 from .runner import Runner
 from .util import *
 
@@ -0,0 +1,88 @@
+"""
+pymoss.archive -- Pre-serialized archive submissions shared by many runners
+"""
+
+import fnmatch, hashlib, json, os, shutil, tempfile
+
+from . import config, util
+from .runner import Runner
+
+class Archive(object):
+    INDEX = "index.json"
+    TMP_PREFIX = "moss_archive_"
+
+    def __init__(self, lang, dir=None):
+        """ lang: Language of the submissions (see Runner)
+            dir: Directory to keep the serialized submissions in. Reused across
+                 runs as long as the archived directories do not change.
+                 (default: new temporary directory)
+        """
+        assert lang in Runner.LANGUAGES, lang
+        if dir is None: dir = tempfile.mkdtemp(prefix=self.TMP_PREFIX, dir=config.TMPDIR)
+        self.lang = lang
+        self.dir = dir
+        self.sources = []
+        self.submits = []
+        self.signature = None
+
+    def add_all(self, dir, prefix=None, skip=set()):
+        """ Add all submissions in a directory (see Runner.add_all).
+            Nothing is read until build().
+        """
+        assert os.path.isdir(dir), dir
+        self.sources.append((dir, prefix, sorted(skip)))
+
+    def build(self):
+        """ Serialize all submissions, unless the archive is up to date. """
+        signature = self._signature() # stats every archived file, so only once
+        if not self.is_stale(signature): return
+        if self._load(signature): return
+
+        if os.path.exists(self.dir): shutil.rmtree(self.dir)
+        runner = Runner(self.lang, tmpdir=self.dir)
+        for dir, prefix, skip in self.sources:
+            runner.add_all(dir, util.ARCHIVE, prefix, set(skip))
+        self.submits = sorted(runner.submits.values())
+        self.signature = signature
+        with open(os.path.join(self.dir, self.INDEX), "w") as f:
+            json.dump({"signature": signature,
+                       "submits": [(s.name, s.lines) for s in self.submits]}, f)
+
+    def is_stale(self, signature=None):
+        """ Whether the archived directories changed since the last build().
+            signature: Current signature of the archived directories, if already computed
+        """
+        if signature is None: signature = self._signature()
+        return not os.path.isdir(self.dir) or signature != self.signature
+
+    def cleanup(self):
+        if os.path.exists(self.dir): shutil.rmtree(self.dir)
+        self.signature = None
+
+    def _load(self, signature):
+        index = os.path.join(self.dir, self.INDEX)
+        if not os.path.exists(index): return False
+        with open(index) as f: data = json.load(f)
+        if data["signature"] != signature: return False
+        self.submits = []
+        for i, (name, lines) in enumerate(data["submits"]):
+            s = util.Submit(util.ARCHIVE, i, str(name))
+            s.lines = lines
+            self.submits.append(s)
+        self.signature = signature
+        return True
+
+    def _signature(self):
+        # Directory mtimes catch added/removed submissions, file stats catch edits
+        h = hashlib.sha1(repr((self.lang, self.sources)))
+        for dir, _, skip in self.sources:
+            for d in sorted(os.listdir(dir)):
+                path = os.path.join(dir, d)
+                if not os.path.isdir(path) or any(fnmatch.fnmatch(d, g) for g in skip): continue
+                h.update("%s %d\n" % (d, os.stat(path).st_mtime))
+                for file in sorted(os.listdir(path)):
+                    st = os.stat(os.path.join(path, file))
+                    h.update("%s %d %d\n" % (file, st.st_size, st.st_mtime))
+        return h.hexdigest()
+
+# vim: et sw=4 ts=4
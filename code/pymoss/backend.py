@@ -0,0 +1,221 @@
+"""
+pymoss.backend -- Similarity backends
+
+A backend reads a manifest (see Submit.manifest_line) and writes a results file
+in the MOSS results format, which Runner parses into util.Pairs. The submission
+files of a manifest are relative to its directory.
+"""
+
+import collections, os, re, zlib
+from multiprocessing.pool import ThreadPool
+
+from . import command, config
+
+class Backend(object):
+    NAME = None
+
+    def run(self, threshold, manifest, results):
+        """ Compare the submissions in a manifest.
+            threshold: Number of submissions a passage may appear in before it is ignored
+            manifest: Manifest file to read
+            results: Results file to write
+        """
+        raise NotImplementedError
+
+    def run_all(self, threshold, runs):
+        """ Compare the submissions of many independent manifests.
+            runs: List of (manifest, results) files
+            By default, up to config.BACKEND_PROCS runs are executed at once.
+        """
+        if len(runs) < 2 or config.BACKEND_PROCS < 2:
+            for manifest, results in runs: self.run(threshold, manifest, results)
+            return
+        pool = ThreadPool(min(config.BACKEND_PROCS, len(runs)))
+        try: pool.map(lambda run: self.run(threshold, *run), runs)
+        finally:
+            pool.close()
+            pool.join()
+
+class MossBackend(Backend):
+    """ The external MOSS binary (bin/moss). """
+    NAME = "moss"
+    BINARY = os.path.realpath(os.path.join(os.path.dirname(__file__), "bin", "moss"))
+    # These options were hard-coded in the Perl script (some were vars but not user-settable).
+    MAGIC_ARGS = ["-p", "24", "-t", "26", "-g", "10", "-w", "5"]
+
+    def run(self, threshold, manifest, results):
+        args = ["-n", str(threshold), "-a", os.path.abspath(manifest), "-o", os.path.abspath(results)]
+        with open(os.devnull, "w") as NULL:
+            errors = command.run("moss", [self.BINARY] + self.MAGIC_ARGS + args, stdout=NULL,
+                                 cwd=os.path.dirname(manifest) or None)[2].strip()
+        if errors: raise RuntimeError("MOSS errors:\n%s" % errors)
+
+class WinnowBackend(Backend):
+    """ In-process k-gram winnowing (Schleimer et al., SIGMOD 2003).
+
+        Tokens are normalized (identifiers, numbers and strings lose their
+        values), hashed as k-grams and winnowed with a window of w hashes.
+        Matching fingerprints between two submissions are chained into regions.
+    """
+    NAME = "winnow"
+    HEADER = ">>>> file: "
+    BASE_ID = 0
+    KEYWORDS = set("""abstract assert auto bool boolean break byte case catch char class const
+        continue default define delete do double else enum extends extern false final finally
+        float for goto if implements import include instanceof int interface long namespace native
+        new null NULL package private protected public register return short signed sizeof static
+        struct super switch synchronized template this throw throws true try typedef typename union
+        unsigned using void volatile while""".split())
+    # Strings come first so that "//" inside a string is not a comment
+    COMMENT_RE = re.compile(r'"(?:\\.|[^"\\\n])*"|\'(?:\\.|[^\'\\\n])*\'|//[^\n]*|/\*.*?\*/', re.S)
+    TOKEN_RE = re.compile(r'[A-Za-z_]\w*|\d[\w.]*|"(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\'|\S')
+    WORD_RE = re.compile(r'\S+')
+    # tmpfile (device, inode, size, mtime, ...) -> _Fingerprints, shared by all
+    # instances in a process; hardlinked archive files share entries
+    _cache = collections.OrderedDict()
+
+    def __init__(self, k=config.WINNOW_K, w=config.WINNOW_W):
+        assert k > 0 and w > 0, (k, w)
+        self.k, self.w = k, w
+
+    def run_all(self, threshold, runs):
+        """ Runs are compared in turn, in-process: fingerprints are shared through
+            the cache and threads would only contend for the interpreter.
+        """
+        for manifest, results in runs: self.run(threshold, manifest, results)
+
+    def run(self, threshold, manifest, results):
+        subs = []
+        dir = os.path.dirname(manifest)
+        with open(manifest) as f:
+            for line in f:
+                tmpfile, id, lang, name = line.rstrip("\n").split(" ", 3)
+                subs.append((int(id), name, self._fingerprint(os.path.join(dir, tmpfile), lang)))
+
+        # hash -> {submission index: [token positions]}
+        index = collections.defaultdict(dict)
+        base = set()
+        for i, (id, _, fp) in enumerate(subs):
+            if id == self.BASE_ID:
+                base.update(fp.hashes)
+                continue
+            for h, pos in zip(fp.hashes, fp.positions):
+                index[h].setdefault(i, []).append(pos)
+
+        # (i, j) -> [(pos in i, pos in j)], only across different ids
+        matches = collections.defaultdict(list)
+        for h, occ in index.iteritems():
+            if len(occ) < 2 or len(occ) > threshold or h in base: continue
+            groups = collections.defaultdict(list)
+            for i in occ: groups[subs[i][0]].append(i)
+            if len(groups) < 2: continue
+            ids = sorted(groups)
+            for a, id1 in enumerate(ids):
+                for id2 in ids[a + 1:]:
+                    for i in groups[id1]:
+                        for j in groups[id2]:
+                            key, pi, pj = ((i, j), occ[i], occ[j]) if i < j else ((j, i), occ[j], occ[i])
+                            matches[key].extend((x, y) for x in pi for y in pj)
+
+        with open(results, "w") as f:
+            for (i, j) in sorted(matches):
+                line = self._result_line(subs[i], subs[j], matches[(i, j)])
+                if line: f.write(line)
+
+    def _result_line(self, sub1, sub2, matches):
+        (_, name1, fp1), (_, name2, fp2) = sub1, sub2
+        regions = self._regions(fp1, fp2, matches)
+        if not regions: return None
+        tokens = sum(r[4] for r in regions)
+        lines = sum(r[1] - r[0] + 1 for r in regions)
+        percent = tuple(tokens * 100 // fp.tokens for fp in (fp1, fp2))
+        return "%s + %s: tokens %d   lines %d# total tokens %d + %d, total lines %d + %d, " \
+               "percentage matched %d%% + %d%%# %s\n" % \
+               (name1, name2, tokens, lines, fp1.tokens, fp2.tokens, fp1.lines + 1, fp2.lines + 1,
+                percent[0], percent[1], "# ".join("%d-%d, %d-%d: %d" % r for r in regions))
+
+    def _regions(self, fp1, fp2, matches):
+        """ Chain matched k-gram positions that advance together in both submissions. """
+        gap = self.k + self.w
+        runs = []
+        for x, y in sorted(set(matches)):
+            if runs:
+                r = runs[-1]
+                if r[1] < x <= r[1] + gap and r[3] < y <= r[3] + gap:
+                    r[1], r[3] = x, y
+                    continue
+                if x <= r[1]: continue # already covered
+            runs.append([x, x, y, y])
+
+        regions = []
+        end = -1
+        for x1, x2, y1, y2 in runs:
+            x1 = max(x1, end + 1)
+            end = x2 + self.k - 1
+            if x1 > end: continue
+            regions.append((fp1.token_lines[x1], fp1.token_lines[end],
+                            fp2.token_lines[y1], fp2.token_lines[y2 + self.k - 1], end - x1 + 1))
+        return regions
+
+    def _fingerprint(self, tmpfile, lang):
+        st = os.stat(tmpfile)
+        key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime, lang, self.k, self.w)
+        cache = self._cache
+        if key in cache:
+            fp = cache.pop(key)
+        else:
+            with open(tmpfile) as f: content = f.read()
+            fp = _Fingerprints(self._tokenize(content, lang), content.count("\n"), self.k, self.w)
+            while cache and len(cache) >= config.WINNOW_CACHE_SIZE: cache.popitem(last=False)
+        cache[key] = fp
+        return fp
+
+    def _tokenize(self, content, lang):
+        """ Returns a list of (normalized token, line number), lines counted from 1. """
+        if lang == "ascii":
+            token_re = self.WORD_RE
+        else:
+            token_re = self.TOKEN_RE
+            strip = lambda m: m.group(0) if m.group(0)[0] in "\"'" else "\n" * m.group(0).count("\n")
+            content = self.COMMENT_RE.sub(strip, content)
+        tokens = []
+        for n, line in enumerate(content.split("\n"), 1):
+            if line.startswith(self.HEADER): continue
+            for m in token_re.finditer(line):
+                t = m.group(0)
+                if lang != "ascii":
+                    if t[0] in "\"'": t = "S"
+                    elif t[0].isdigit(): t = "N"
+                    elif (t[0].isalpha() or t[0] == "_") and t not in self.KEYWORDS: t = "V"
+                tokens.append((t, n))
+        return tokens
+
+class _Fingerprints(object):
+    """ Winnowed k-gram hashes of one submission. """
+    def __init__(self, tokens, lines, k, w):
+        self.tokens = len(tokens)
+        self.lines = lines
+        self.token_lines = [n for _, n in tokens]
+        words = [t for t, _ in tokens]
+        kgrams = [zlib.crc32(" ".join(words[i:i + k])) & 0xffffffff
+                  for i in range(len(words) - k + 1)]
+        self.hashes, self.positions = [], []
+        last = -1
+        for i in range(max(len(kgrams) - w + 1, 1 if kgrams else 0)):
+            window = kgrams[i:i + w]
+            # rightmost minimum, as in the winnowing paper
+            j = i + len(window) - 1 - min(range(len(window)), key=lambda x: (window[-1 - x], x))
+            if j != last:
+                self.hashes.append(kgrams[j])
+                self.positions.append(j)
+                last = j
+
+BACKENDS = dict((b.NAME, b) for b in (MossBackend, WinnowBackend))
+
+def get(name=None):
+    """ Returns a new backend by name (default: config.BACKEND). """
+    if name is None: name = config.BACKEND
+    assert name in BACKENDS, name
+    return BACKENDS[name]()
+
+# vim: et sw=4 ts=4
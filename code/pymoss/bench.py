@@ -0,0 +1,79 @@
+"""
+pymoss.bench -- Micro-benchmarks
+
+Run from the code directory:
+    python -m pymoss.bench [--lines N] [--regions N] [--repeat N] [--number N] [--min-speedup X]
+
+Compares Pair.find_common against the line-by-line implementation it
+replaced, on large submissions with many regions, and fails if the regions
+differ or the speedup drops below --min-speedup.
+"""
+
+import argparse, random, sys, timeit
+
+from . import util
+
+def find_common_lines(pair, nobase):
+    """ The original line-by-line Pair.find_common, returning its regions. """
+    regions = ([], [])
+    for sub in range(2):
+        lines = [-1 for _ in range(pair.submits[sub].lines + 1)]
+        for r in nobase:
+            for l in range(r[sub].start, r[sub].end + 1): lines[l] = pair.COMMON
+        for i, r in enumerate(pair.match):
+            for l in range(r[sub].start, r[sub].end + 1): lines[l] = i
+        start = 0
+        cur = -1
+        for i, v in enumerate(lines):
+            if v == cur: continue
+            if cur != -1: regions[sub].append((util.Range(start, i - 1), cur))
+            cur = v
+            start = i
+    return regions
+
+def make_pair(rng, nlines, nregions):
+    """ Returns (pair, nobase) of two nlines-line submissions with nregions
+        matched regions and as many common regions, of up to 1/20 of the file.
+    """
+    submits = []
+    for type, name in ((util.CURRENT, "a_1"), (util.ARCHIVE, "b_1")):
+        s = util.Submit(type, 0, name)
+        s.lines = nlines
+        submits.append(s)
+    def region():
+        start = rng.randint(0, nlines - 1)
+        return util.Range(start, min(start + rng.randint(0, nlines // 20), nlines - 1))
+    match = [(region(), region(), rng.randint(1, 100)) for _ in range(nregions)]
+    nobase = [(region(), region(), 0) for _ in range(nregions)]
+    return util.Pair(submits[0], submits[1], sum(t for _, _, t in match), match), nobase
+
+def bench_find_common(nlines, nregions, repeat, number):
+    pair, nobase = make_pair(random.Random(0), nlines, nregions)
+    expected = find_common_lines(pair, nobase)
+    def run():
+        pair.regions = None
+        pair.find_common(pair.tokens.match, nobase)
+    run()
+    if pair.regions != expected:
+        raise AssertionError("find_common regions differ from the line-by-line implementation")
+    new = min(timeit.repeat(run, number=number, repeat=repeat)) / number
+    old = min(timeit.repeat(lambda: find_common_lines(pair, nobase), number=number, repeat=repeat)) / number
+    print "find_common: %d lines, %d regions: %.2f ms (line-by-line %.2f ms, %.1fx)" % \
+          (nlines, nregions, new * 1000, old * 1000, old / new)
+    return old / new
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="pymoss micro-benchmarks")
+    parser.add_argument("--lines", type=int, default=20000)
+    parser.add_argument("--regions", type=int, default=500)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--number", type=int, default=10)
+    parser.add_argument("--min-speedup", type=float, default=1.0)
+    args = parser.parse_args(argv)
+    speedup = bench_find_common(args.lines, args.regions, args.repeat, args.number)
+    return 0 if speedup >= args.min_speedup else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+# vim: et sw=4 ts=4
@@ -0,0 +1,79 @@
+"""
+pymoss.command -- Running external commands (git, MOSS)
+
+Commands are grouped by kind. At most config.COMMAND_LIMITS[kind] commands of
+a kind run at once per process, whichever thread starts them, and a command
+running longer than config.COMMAND_TIMEOUTS[kind] seconds is killed.
+cancel() kills the running commands, e.g. when a run is interrupted.
+"""
+
+import os, subprocess, threading
+
+from . import config
+
+class CommandError(RuntimeError):
+    """ A command was killed before it finished. """
+
+class CommandTimeout(CommandError):
+    pass
+
+class CommandCancelled(CommandError):
+    pass
+
+_lock = threading.Lock()
+_semaphores = {} # kind -> BoundedSemaphore
+_running = {}    # Popen -> kind
+_killed = {}     # Popen -> exception to raise in the thread that started it
+
+def _semaphore(kind):
+    with _lock:
+        if kind not in _semaphores:
+            _semaphores[kind] = threading.BoundedSemaphore(config.COMMAND_LIMITS.get(kind, 1))
+        return _semaphores[kind]
+
+def _kill(proc, error):
+    with _lock:
+        if proc not in _running or proc in _killed: return
+        _killed[proc] = error
+    try: proc.kill()
+    except OSError: pass # already exited
+
+def run(kind, args, timeout=None, stdin=None, **popen_args):
+    """ Run a command and wait for it.
+        kind: Kind of command ("git", "moss", ...)
+        args: Arguments, or a command line with shell=True
+        timeout: Seconds before the command is killed (default: config.COMMAND_TIMEOUTS)
+        stdin: Data to write to the command's input
+        Returns (returncode, stdout, stderr); output is captured unless passed in popen_args.
+        Raises CommandTimeout or CommandCancelled if the command was killed.
+    """
+    if timeout is None: timeout = config.COMMAND_TIMEOUTS.get(kind)
+    popen_args.setdefault("stdout", subprocess.PIPE)
+    popen_args.setdefault("stderr", subprocess.PIPE)
+    if stdin is not None: popen_args["stdin"] = subprocess.PIPE
+    with _semaphore(kind):
+        proc = subprocess.Popen(args, **popen_args)
+        with _lock: _running[proc] = kind
+        timer = None
+        if timeout:
+            timer = threading.Timer(timeout, _kill, (proc, CommandTimeout(
+                "%s command timed out after %s s: %s" % (kind, timeout, args))))
+            timer.daemon = True
+            timer.start()
+        try: out, err = proc.communicate(stdin)
+        finally:
+            if timer: timer.cancel()
+            with _lock:
+                del _running[proc]
+                error = _killed.pop(proc, None)
+    if error: raise error
+    return proc.returncode, out, err
+
+def cancel(kind=None):
+    """ Kill the running commands (of one kind, or all), whose run() raises CommandCancelled. """
+    with _lock:
+        procs = [(proc, k) for proc, k in _running.items() if kind is None or k == kind]
+    for proc, k in procs:
+        _kill(proc, CommandCancelled("%s command cancelled" % k))
+
+# vim: et sw=4 ts=4
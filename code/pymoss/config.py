@@ -20,10 +20,51 @@ MATCH_FILES = {
 # Default number of pairs to report (can be changed as arg to run())
 NPAIRS = 2
 
+# How run(outdir) saves its output (can be changed as arg to run()):
+# - "copy": copy the whole tmpdir
+# - "move": move only the files needed by reports
+# - "link": hardlink only the files needed by reports
+OUTPUT = "copy"
+
 # Default number of occurrences before code is considered common (can be set in Moss constructor)
 THRESHOLD = 100000000
 THRESHOLD = 10
 
+#--- Backends ---#
+
+# Default similarity backend (see backend.BACKENDS): "moss" (bin/moss) or "winnow" (in-process)
+BACKEND = "moss"
+
+# Winnowing backend: k-gram length (tokens), window size (hashes) and
+# number of submissions whose fingerprints are cached per backend
+WINNOW_K = 12
+WINNOW_W = 8
+WINNOW_CACHE_SIZE = 10000
+
+# Maximum number of backend processes run at once for independent runs
+# (e.g. finding the common code of each reported pair)
+BACKEND_PROCS = 4
+
+#--- External commands (see command.py) ---#
+
+# Maximum number of commands of each kind run at once per process,
+# and seconds before one is killed (None: no limit)
+COMMAND_LIMITS = {"git": 8, "moss": BACKEND_PROCS}
+COMMAND_TIMEOUTS = {"git": 300, "moss": None}
+
+#--- Reports ---#
+
+# Highlighted source lines cached for reports, keyed by content: maximum total
+# size (bytes of html) kept in memory, and directory to also store them in so
+# they persist across runs (None: memory only)
+HIGHLIGHT_CACHE_SIZE = 64 * 2**20
+HIGHLIGHT_CACHE_DIR = None
+
+# Directory to store compiled templates in, shared across runs (None: compile
+# in memory once per process). Modules are named after their templates only,
+# so use a directory of this checkout's own, writable by whoever runs it.
+TEMPLATE_MODULE_DIR = None
+
 #--- Directories ---#
 
 # Location to store report output (html)
@@ -4,27 +4,38 @@ pymoss.html
 Michael <mchang@cs>, 2015
 """
 
-import datetime, os, shutil
+import collections, datetime, gzip, hashlib, io, json, os, shutil, zlib
 from mako import exceptions
 from mako.lookup import TemplateLookup
-from pygments import highlight
+from pygments import format, lex
 from pygments.formatters import HtmlFormatter
 from pygments.lexers import get_lexer_by_name
 
 from . import config, util
 
 class _Formatter(HtmlFormatter):
-    def __init__(self, pair, idx, ncolors, **opts):
+    def __init__(self, pair, idx, ncolors, lines=None, **opts):
+        """ lines: Highlighted source lines (see source_lines) to format instead
+                   of a token stream
+        """
         super(_Formatter, self).__init__(cssclass="code", linenos="inline", **opts)
         self.idx = idx
         self.ncolors = ncolors
+        self.lines = lines
         regions = pair.regions[idx]
         self.starts = {r[0].start: r[1] for r in regions}
         self.ends = set(r[0].end for r in regions)
 
-    def _format_lines(self, src):
+    def source_lines(self, content, lexer):
+        """ Returns the highlighted lines of content, before regions are added. """
         base = super(_Formatter, self)._format_lines
-        return self._highlight(base(src))
+        return [line for _, line in base(lex(content, lexer))]
+
+    def _format_lines(self, src):
+        if self.lines is None:
+            base = super(_Formatter, self)._format_lines
+            return self._highlight(base(src))
+        return self._highlight((1, line) for line in self.lines)
 
     def _highlight(self, src):
         n = 0
@@ -60,14 +71,110 @@ class _Formatter(HtmlFormatter):
             yield t, '<span class="lineno">%*s </span>' % (mw, (num % st and ' ' or num)) + line
             num += 1
 
+class _HighlightCache(object):
+    """ LRU cache of highlighted source lines, keyed by (content hash, lexer), so
+        that a submission appearing in many reports is only lexed once.
+        Bounded by the total size of the cached lines; if dir is set, lines are
+        also stored there and shared across processes and runs.
+    """
+    def __init__(self, max_size, dir=None):
+        self.max_size = max_size
+        self.dir = dir
+        self.size = 0
+        self.lines = collections.OrderedDict()
+
+    def get(self, content, lexer, fmt):
+        """ Returns the highlighted lines of content (see _Formatter.source_lines). """
+        key = (hashlib.sha1(content).hexdigest(), lexer.aliases[0])
+        lines = self.lines.pop(key, None)
+        if lines is None:
+            lines = self._load(key)
+            if lines is None:
+                lines = fmt.source_lines(content, lexer)
+                self._save(key, lines)
+            size = sum(len(line) for line in lines)
+            if size > self.max_size: return lines
+            self.size += size
+            while self.size > self.max_size:
+                self.size -= sum(len(line) for line in self.lines.popitem(last=False)[1])
+        self.lines[key] = lines
+        return lines
+
+    def _path(self, key):
+        return os.path.join(self.dir, "%s.%s" % key)
+
+    def _load(self, key):
+        if not self.dir or not os.path.exists(self._path(key)): return None
+        with open(self._path(key), "rb") as f: return json.loads(zlib.decompress(f.read()))
+
+    def _save(self, key, lines):
+        if not self.dir: return
+        if not os.path.isdir(self.dir): os.makedirs(self.dir)
+        path = self._path(key)
+        with open("%s.%d" % (path, os.getpid()), "wb") as f:
+            f.write(zlib.compress(json.dumps(lines)))
+        os.rename("%s.%d" % (path, os.getpid()), path)
+
+_lookup = None
+
+def get_lookup():
+    """ Returns the template lookup shared by all reports in a process, which
+        compiles each template once (kept in config.TEMPLATE_MODULE_DIR, if set).
+    """
+    global _lookup
+    if _lookup is None:
+        _lookup = TemplateLookup([Html.TMPL_DIR], module_directory=config.TEMPLATE_MODULE_DIR)
+    return _lookup
+
+def warm_up():
+    """ Compile the report templates ahead of time, e.g. before forking workers.
+        Static assets (Html.ASSETS) are not templates and are left out.
+    """
+    lookup = get_lookup()
+    for name in sorted(os.listdir(Html.TMPL_DIR)):
+        if name.endswith(".html"): lookup.get_template(name)
+
 class Html(object):
     LEXER_MAP = {"cc": "cpp"}
     NUM_COLORS = 7
     TMPL_DIR = os.path.realpath(os.path.join(os.path.dirname(__file__), "templates"))
-
-    def __init__(self, runner, desc=""):
+    ASSETS = ("jquery-1.11.3.min.js", "report.css", "report.js") # static files of reports
+    _cache = None # _HighlightCache shared by all instances in a process
+    _assets = {}  # asset name -> contents, for inlined assets
+
+    def __init__(self, runner=None, desc="", lang=None, sources=None, assets=None):
+        """ runner: Runner whose pairs are reported (not needed with lang and sources)
+            desc: Description shown in the report titles
+            lang: Language of the submissions (default: runner.lang)
+            sources: Dictionary of submission name -> contents to report from,
+                     instead of the runner's files
+            assets: URL of a directory written by write_assets, relative to the
+                    reports, to link static files from (None to inline them)
+        """
+        assert runner or (lang and sources is not None)
         self.runner = runner
         self.desc = desc
+        self.lang = lang or runner.lang
+        self.sources = sources or {}
+        self.assets = assets if assets is None or assets.endswith("/") else assets + "/"
+
+    @classmethod
+    def write_assets(cls, dir):
+        """ Write the static files shared by reports (see assets) to dir, if missing. """
+        if not os.path.isdir(dir): os.makedirs(dir)
+        for name in cls.ASSETS:
+            path = os.path.join(dir, name)
+            if os.path.exists(path): continue
+            shutil.copyfile(os.path.join(cls.TMPL_DIR, name), "%s.%d" % (path, os.getpid()))
+            os.rename("%s.%d" % (path, os.getpid()), path)
+
+    @classmethod
+    def read_asset(cls, name):
+        """ Contents of a static asset, inlined as is (not as a template). """
+        if name not in cls._assets:
+            with io.open(os.path.join(cls.TMPL_DIR, name), encoding="utf-8") as f:
+                cls._assets[name] = f.read()
+        return cls._assets[name]
 
     def gen_all(self, dir=None):
         """ Generate the full report, including index page.
@@ -80,19 +187,24 @@ class Html(object):
     def gen_report(self, pair, file):
         """ Generate a report for a single pair.
             pair: A Pair from runner.pairs
-            file: The filename to output to
+            file: The filename to output to (gzip-compressed if it ends with .gz)
         """
-        ctx = dict(pair.__dict__)
+        ctx = dict((name, getattr(pair, name)) for name in pair.__slots__)
         ctx["files"] = tuple(self._format_file(pair, i) for i in range(2))
         self._render("report", ctx, file)
 
     def _format_file(self, pair, idx):
         s = pair.submits[idx]
-        with open(s.tmpfile(self.runner.tmpdir)) as f: content = f.read()
-        lang = self.runner.lang
+        content = self.sources.get(s.name)
+        if content is None:
+            with open(s.tmpfile(self.runner.reportdir)) as f: content = f.read()
+        lang = self.lang
         if lang in self.LEXER_MAP: lang = self.LEXER_MAP[lang]
         fmt = _Formatter(pair, idx, self.NUM_COLORS)
-        return highlight(content, get_lexer_by_name(lang, stripnl=False), fmt)
+        if Html._cache is None:
+            Html._cache = _HighlightCache(config.HIGHLIGHT_CACHE_SIZE, config.HIGHLIGHT_CACHE_DIR)
+        fmt.lines = Html._cache.get(content, get_lexer_by_name(lang, stripnl=False), fmt)
+        return format((), fmt)
 
     def _gen_all(self, dir):
         tmpdir = os.path.join(self.runner.tmpdir, "www")
@@ -114,10 +226,13 @@ class Html(object):
     def _render(self, tmpl, ctx, file):
         ctx["desc"] = self.desc
         ctx["NUM_COLORS"] = self.NUM_COLORS
-        t = TemplateLookup([self.TMPL_DIR]).get_template(tmpl + ".html")
+        ctx["assets"] = self.assets
+        ctx["read_asset"] = self.read_asset
+        t = get_lookup().get_template(tmpl + ".html")
         assert not os.path.exists(file)
+        opener = gzip.open if file.endswith(".gz") else open
         try: 
-            with open(file, "w") as f: f.write(t.render(**ctx))
+            with opener(file, "w") as f: f.write(t.render(**ctx))
         except:
             print(exceptions.text_error_template().render())
             raise
@@ -0,0 +1,141 @@
+"""
+pymoss.index -- On-disk inverted fingerprint index of an Archive
+
+Maps winnowed fingerprint hashes to (archive submission, line range), so that
+a submission can be matched against the archive by lookups instead of a full run.
+"""
+
+import array, bisect, collections, hashlib, json, mmap, os, struct
+
+from . import util
+from .backend import WinnowBackend
+
+class _Column(object):
+    """ Read-only view of one uint32 column of a memory-mapped file. """
+    ITEM = struct.Struct("=I") # native order, as written by array.tofile
+
+    def __init__(self, buf, offset, n):
+        self.buf, self.offset, self.n = buf, offset, n
+
+    def __len__(self): return self.n
+    def __getitem__(self, i): return self.ITEM.unpack_from(self.buf, self.offset + i * 4)[0]
+
+class FingerprintIndex(object):
+    """ The index is a directory holding:
+            records: four uint32 columns (hash, submit, start line, end line), sorted by hash
+            submits.json: indexed submissions and the Archive signature they came from
+        Submissions are (re)fingerprinted only when their content changes.
+    """
+    RECORDS = "records"
+    SUBMITS = "submits.json"
+    COLUMNS = 4
+
+    def __init__(self, dir, k=None, w=None):
+        self.dir = dir
+        self.winnow = WinnowBackend(*(x for x in (k, w) if x is not None))
+        self.submits = [] # submit id -> [name, content digest], None once removed
+        self.signature = None
+        self.n = 0
+        self.loaded = False
+        self._map = None
+        if os.path.exists(os.path.join(dir, self.SUBMITS)):
+            with open(os.path.join(dir, self.SUBMITS)) as f: data = json.load(f)
+            if (data["k"], data["w"]) == (self.winnow.k, self.winnow.w):
+                self.submits, self.signature = data["submits"], data["signature"]
+                self._open()
+
+    def update(self, archive):
+        """ Bring the index up to date with a built Archive, fingerprinting only
+            submissions that were added or changed since the last update.
+        """
+        if archive.signature == self.signature and self.loaded: return
+        current = {}
+        for s in archive.submits:
+            with open(s.tmpfile(archive.dir), "rb") as f:
+                current[s.name] = (hashlib.sha1(f.read()).hexdigest(), s)
+
+        keep = set()
+        for id, entry in enumerate(self.submits):
+            if entry is None: continue
+            name, digest = entry
+            if name in current and current[name][0] == digest:
+                keep.add(id)
+                del current[name]
+            else: self.submits[id] = None
+
+        records = [r for r in self._records() if r[1] in keep]
+        for name in sorted(current):
+            digest, s = current[name]
+            id = len(self.submits)
+            self.submits.append([name, digest])
+            fp = self.winnow._fingerprint(s.tmpfile(archive.dir), archive.lang)
+            for h, pos in zip(fp.hashes, fp.positions):
+                records.append((h, id, fp.token_lines[pos], fp.token_lines[pos + self.winnow.k - 1]))
+        self.signature = archive.signature
+        self._write(sorted(records))
+
+    def lookup(self, h):
+        """ Returns a list of (submission name, Range) containing a fingerprint hash. """
+        if not self.n: return []
+        hashes, submits, starts, ends = self._columns
+        i = bisect.bisect_left(hashes, h)
+        found = []
+        while i < self.n and hashes[i] == h:
+            found.append((str(self.submits[submits[i]][0]), util.Range(starts[i], ends[i])))
+            i += 1
+        return found
+
+    def candidates(self, tmpfile, lang, limit=None, student=None):
+        """ Returns archive submission names sharing fingerprints with a serialized
+            submission (e.g. Submit.tmpfile()), most shared fingerprints first.
+            student: Leave out this student's submissions, which would only make self pairs
+        """
+        fp = self.winnow._fingerprint(tmpfile, lang)
+        hits = collections.Counter()
+        for h in set(fp.hashes):
+            hits.update(set(name for name, _ in self.lookup(h)))
+        if student is not None:
+            for name in [name for name in hits if util.Submit.student_of(name) == student]:
+                del hits[name]
+        return [name for name, _ in hits.most_common(limit)]
+
+    def close(self):
+        if self._map is not None: self._map.close()
+        self._map = None
+        self.n = 0
+        self.loaded = False
+
+    def _records(self):
+        if not self.n: return []
+        hashes, submits, starts, ends = (self._read_column(c) for c in range(self.COLUMNS))
+        return zip(hashes, submits, starts, ends)
+
+    def _read_column(self, c):
+        column = array.array("I")
+        column.fromstring(self._map[c * self.n * 4:(c + 1) * self.n * 4])
+        return column
+
+    def _write(self, records):
+        self.close()
+        if not os.path.isdir(self.dir): os.makedirs(self.dir)
+        path = os.path.join(self.dir, self.RECORDS)
+        with open(path + ".tmp", "wb") as f:
+            for c in range(self.COLUMNS):
+                array.array("I", (r[c] for r in records)).tofile(f)
+        os.rename(path + ".tmp", path)
+        with open(os.path.join(self.dir, self.SUBMITS), "w") as f:
+            json.dump({"k": self.winnow.k, "w": self.winnow.w,
+                       "signature": self.signature, "submits": self.submits}, f)
+        self._open()
+
+    def _open(self):
+        path = os.path.join(self.dir, self.RECORDS)
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        self.n = size // (4 * self.COLUMNS)
+        self.loaded = True
+        if not self.n: return
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._columns = tuple(_Column(self._map, c * self.n * 4, self.n) for c in range(self.COLUMNS))
+
+# vim: et sw=4 ts=4
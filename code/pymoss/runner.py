@@ -4,33 +4,53 @@ pymoss.moss
 Michael <mchang@cs>, 2015
 """
 
-import fnmatch, glob, os, re, shutil, subprocess, tempfile
+import fnmatch, glob, heapq, itertools, os, re, shutil, tempfile
 
-from . import config, util
+from . import backend as backends, config, util
 
 class Runner(object):
-    BINARY = os.path.realpath(os.path.join(os.path.dirname(__file__), "bin", "moss"))
     LANGUAGES = set(config.MATCH_FILES.keys())
     NOBASE_THRESHOLD = 1000000
+    OUTPUTS = ("copy", "move", "link")
     TMP_PREFIX = "moss_"
+    # Results lines (percentages are not checked, see Pair.calc_percent)
+    LINE_RE = re.compile(r"(.+) \+ (.+): tokens (-?\d+)   lines (-?\d+)# total tokens (-?\d+) \+ (-?\d+), "
+                         r"total lines (-?\d+) \+ (-?\d+), percentage matched -?\d+% \+ -?\d+%# (.*?)\s*$")
+    REGION_RE = re.compile(r"(\d+)-(\d+), (\d+)-(\d+): (-?\d+)")
+    REGION_SEP = "# "
 
-    def __init__(self, lang, threshold=config.THRESHOLD, tmpdir=None):
+    def __init__(self, lang, threshold=config.THRESHOLD, tmpdir=None, backend=None):
+        """ lang: Language of the submissions (one of LANGUAGES)
+            threshold: Number of occurrences before code is considered common
+            tmpdir: Working directory (default: new temporary directory)
+            backend: A backend.Backend, or its name (default: config.BACKEND)
+        """
         assert lang in self.LANGUAGES, lang
         assert threshold > 1, threshold
         assert not config.TMPDIR or os.path.isdir(config.TMPDIR), config.TMPDIR
 
         self.lang = lang
         self.threshold = threshold
+        if not isinstance(backend, backends.Backend): backend = backends.get(backend)
+        self.backend = backend
         self.counts = [0 for _ in range(util.NTYPES)]
         self.pairs = []
         self.submits = dict()
-        self.tmpdir = tempfile.mkdtemp(prefix=self.TMP_PREFIX, dir=config.TMPDIR)
+        if tmpdir is None:
+            tmpdir = tempfile.mkdtemp(prefix=self.TMP_PREFIX, dir=config.TMPDIR)
+        elif not os.path.isdir(tmpdir):
+            os.makedirs(tmpdir)
+        self.tmpdir = tmpdir
+        self.reportdir = tmpdir # where reports read submissions from
 
-    def add(self, dir, type=util.CURRENT, name=None):
+    def add(self, dir, type=util.CURRENT, name=None, batch=None):
         """ Add a submission.
             dir: Directory containing the submission (non-recursive)
             type: Type of submission (one of config.{STARTER,CURRENT,ARCHIVE}) (default: CURRENT)
             name: Name of submission (shown in report) (default: <dir>)
+            batch: Batch key (e.g. snapshot name) for running many submissions at once.
+                   Batched submissions are not compared with each other, and the top
+                   pairs are reported per batch.
         """
         assert os.path.isdir(dir), dir
         assert type in range(util.NTYPES), type
@@ -38,7 +58,7 @@ class Runner(object):
         assert " + " not in name, "Name cannot contain ' + ': %s" % name
         assert name not in self.submits, name
 
-        s = util.Submit(type, self.counts[type], name)
+        s = util.Submit(type, self.counts[type], name, batch)
         self.counts[type] += 1
         self.submits[name] = s
         files = set(f for pat in config.MATCH_FILES[self.lang] for f in glob.glob(os.path.join(dir, pat)))
@@ -56,43 +76,59 @@ class Runner(object):
                     tmpf.writelines(lines)
                     s.lines += len(lines) + 1
 
-    def add_all(self, dir, type=util.CURRENT, prefix=None, skip=set()):
+    def add_all(self, dir, type=util.CURRENT, prefix=None, skip=set(), batch=None):
         """ Add all submissions in a directory
             dir: Directory containing submissions (each in separate directory)
             type: Type of submission
             prefix: Prefix for submissions (nem in report will be <prefix>/<submit_dir>)
             skip: Set of globs to be skipped (e.g. "test?", "student_*")
+            batch: Batch key for all submissions (see add())
         """
         assert os.path.isdir(dir), dir
         if prefix is None: prefix = dir
         dirs = filter(lambda d: os.path.isdir(os.path.join(dir, d)), os.listdir(dir))
         for d in sorted(dirs):
             if any(fnmatch.fnmatch(d, g) for g in skip): continue
-            self.add(os.path.join(dir, d), type, os.path.join(prefix, d))
+            self.add(os.path.join(dir, d), type, os.path.join(prefix, d), batch)
+
+    def attach(self, archive, names=None):
+        """ Add all submissions of a built pymoss.Archive as ARCHIVE submissions.
+            The serialized files are hardlinked (or symlinked) instead of re-read.
+            names: Only attach these submissions (default: all)
+        """
+        assert archive.lang == self.lang, archive.lang
+        for a in archive.submits:
+            if names is not None and a.name not in names: continue
+            assert a.name not in self.submits, a.name
+            s = util.Submit(util.ARCHIVE, self.counts[util.ARCHIVE], a.name)
+            self.counts[util.ARCHIVE] += 1
+            s.lines = a.lines
+            self.submits[s.name] = s
+            src, dst = a.tmpfile(archive.dir), s.tmpfile(self.tmpdir)
+            try: os.link(src, dst)
+            except OSError: os.symlink(os.path.realpath(src), dst)
 
     def cleanup(self):
         """ Cleanup temp files. Best to call this in a finally clause. """
         if not self.tmpdir: return
         shutil.rmtree(self.tmpdir)
+        if self.reportdir == self.tmpdir: self.reportdir = None
         self.tmpdir = None
 
-    def run(self, outdir=None, npairs=config.NPAIRS):
-        prevwd = os.getcwd()
-        os.chdir(self.tmpdir)
+    def run(self, outdir=None, npairs=config.NPAIRS, output=config.OUTPUT, self_pairs=True):
+        """ Run MOSS and keep the top npairs (non-self) pairs.
+            outdir: Directory to save output to (default: keep it in tmpdir only)
+            output: How to save to outdir (one of OUTPUTS, see config.OUTPUT)
+            self_pairs: Also keep the self pairs ranked above the top npairs
+        """
+        assert output in self.OUTPUTS, output
+        # The working directory is left alone: other threads may use relative paths
+        manifest, results = (os.path.join(self.tmpdir, f) for f in ("manifest", "results"))
 
         util.msg("INPUT: %d starter, %d current, %d archive" % tuple(self.counts))
-        self._gen_manifest("manifest")
-        util.time("Running", lambda: self._exec(self.threshold, "manifest", "results"))
-        util.time("Parsing results", lambda: self._parse_results("results", self._update_submit, self._make_pair,print_tokens=True))
-
-        pairs = self.pairs
-        total_pairs = len(pairs)
-        num_nonself = 0
-        self.pairs = []
-        for p in sorted(pairs, key=lambda p: -p.tokens.match):
-            self.pairs.append(p)
-            if not p.is_self: num_nonself += 1
-            if num_nonself == npairs: break
+        self._gen_manifest(manifest)
+        util.time("Running", lambda: self._exec(self.threshold, manifest, results))
+        total_pairs = util.time("Parsing results", lambda: self._select_pairs(results, npairs, self_pairs))
         self.fname_pairs = {}
         # for p in sorted(pairs, key=lambda p: -p.tokens.match):
         #   if p.is_self: continue
@@ -108,9 +144,20 @@ class Runner(object):
         util.msg("OUTPUT: %d submits, %d pairs, reporting top %d" % \
                   (len(self.submits), total_pairs, len(self.pairs)))
 
-        os.chdir(prevwd)
-        if outdir:
-          shutil.copytree(self.tmpdir, outdir)
+        if outdir: self._save(outdir, output)
+
+    def _save(self, outdir, output):
+        if output == "copy":
+            shutil.copytree(self.tmpdir, outdir)
+        else:
+            os.makedirs(outdir)
+            for s in set(s.name for p in self.pairs for s in p.submits):
+                src, dst = (self.submits[s].tmpfile(d) for d in (self.tmpdir, outdir))
+                if output == "move": shutil.move(src, dst)
+                else:
+                    try: os.link(src, dst)
+                    except OSError: shutil.copy2(src, dst)
+        self.reportdir = outdir
 
     def _gen_manifest(self, file, pair=None):
         assert self.counts[util.CURRENT] < util.Submit.ARCHIVE_SET
@@ -120,74 +167,91 @@ class Runner(object):
             else:
                 for i, s in enumerate(pair.submits, 1): f.write(s.manifest_line(self.lang, i))
 
-    def _make_pair(self, name1, name2, tokens, lines, regions):
+    def _select_pairs(self, file, npairs, self_pairs):
+        """ Parse a results file into self.pairs (best first), keeping the top npairs
+            non-self pairs per batch and, if self_pairs, the self pairs ranked above
+            them. Only kept pairs are built and have their regions parsed.
+            Returns the number of pairs in the file.
+        """
+        best = {}  # batch -> min-heap of (rank, record) of its top non-self pairs
+        selfs = [] # (rank, batch, record) of self pairs ranked above the top so far
+        total = 0
+        for record in self._iter_results(file):
+            name1, name2, tokens, _, counts, _ = record
+            self._update_submit(name1, counts[0], counts[2])
+            self._update_submit(name2, counts[1], counts[3])
+            # more tokens first, then earlier in the file
+            rank = (tokens, -total)
+            total += 1
+            s1, s2 = self.submits[name1], self.submits[name2]
+            heap = best.setdefault(s1.batch, [])
+            if s1.student() == s2.student():
+                if self_pairs and self._ranks_above(rank, heap, npairs):
+                    selfs.append((rank, s1.batch, record))
+            elif len(heap) < npairs:
+                heapq.heappush(heap, (rank, record))
+            elif self._ranks_above(rank, heap, npairs):
+                heapq.heapreplace(heap, (rank, record))
+        kept = [item for heap in best.itervalues() for item in heap]
+        kept.extend((rank, record) for rank, batch, record in selfs
+                    if self._ranks_above(rank, best[batch], npairs))
+        self.pairs = [self._make_pair(*record) for _, record in sorted(kept, reverse=True)]
+        return total
+
+    @staticmethod
+    def _ranks_above(rank, heap, npairs):
+        """ Whether fewer than npairs pairs of a heap rank above rank. """
+        return npairs > 0 and (len(heap) < npairs or rank > heap[0][0])
+
+    def _make_pair(self, name1, name2, tokens, lines, counts, regions):
         s1, s2 = (self.submits[n] for n in (name1, name2))
-        self.pairs.append(util.Pair(s1, s2, tokens, regions))
+        return util.Pair(s1, s2, tokens, self._parse_regions(regions))
 
     def _parse_regions(self, line):
-        REGION_PAT = "(\d+)-(\d+), (\d+)-(\d+): (-?\d+)"
-        REGION_SEP = "# "
-        region_re = re.compile(REGION_PAT)
-
-        regions = []
-        for r in line.split(REGION_SEP):
-            m = region_re.match(r)
-            assert m, line
-            l1, l2, l3, l4, t = (int(x) for x in m.groups())
-            regions.append((util.Range(l1, l2), util.Range(l3, l4), t))
-        return regions
-
-    def _parse_results(self, file, submit_fn, pair_fn, print_tokens=False):
-        LINE_PAT = "(.+) \+ (.+): tokens (-?\d+)   lines (-?\d+)# total tokens (-?\d+) \+ (-?\d+), " \
-                   "total lines (-?\d+) \+ (-?\d+), percentage matched (-?\d+)% \+ (-?\d+)%# (.*)"
-        line_re = re.compile(LINE_PAT)
-
-        len_counts = {}
-        
+        """ Returns the util.Regions of a results line's region list. """
+        found = self.REGION_RE.findall(line)
+        assert len(found) == line.count(self.REGION_SEP) + 1, line
+        return util.Regions.from_columns(zip(*found))
+
+    def _iter_results(self, file):
+        """ Yields (name1, name2, tokens, lines, counts, regions) for each line of a
+            results file, reading it lazily.
+            counts: (total tokens 1, total tokens 2, total lines 1, total lines 2)
+            regions: Unparsed region list (see _parse_regions)
+        """
+        line_re = self.LINE_RE
         with open(file) as f:
             for line in f:
-                line = line.strip()
-                if not line: continue
                 m = line_re.match(line)
-                assert m, line
-                g = list(m.groups())
-                for i in range(2, 10): g[i] = int(g[i])
-                for i in range(2):
-                    t, l, p = (g[i + j] for j in (4, 6, 8))
-                    # Verify percentage calculation
-                    #assert p == g[2] * 100 // t, line
-                    if submit_fn: submit_fn(g[i], t, l)
-
-                # start logging
-                if g[0] not in len_counts:
-                  #print(line)
-                  len_counts[g[0]] = (g[4], g[6])
-                # # figure out uname
-                # uname_fname = g[0].split('/')[-1]
-                # uname, fname = uname_fname.split('_')
-                # if uname not in match_counts:
-                #   # pother_fname, pother_t, pother_tc, pother_po, pother_ps, token_fname, token_t, token_tc, token_po, token_ps
-                #   match_counts[uname] = [''] + [0] * 4 + [''] + [0]*4
-                # other_fname = g[1].split('/')[-1]
-                # if g[9] > match_counts[uname][4]:
-                #   print(line)
-                #   print(g)
-                #   #match_counts[uname][:4] = [other_fname, g[
-
-                # end logging
-
-                regions = self._parse_regions(g[-1])
-                if pair_fn: pair_fn(*(g[:4] + [regions]))
-        # if print_tokens:
-        #   with open(os.path.join(os.getcwd(),'tokens.csv'), 'w') as f:
-        #     f.write('\n'.join(["{},{},{}".format(fname, len_counts[fname][0],len_counts[fname][1]) for fname in sorted(len_counts.keys())]))
-        #     print("wrote student file lengths (tokens/lines) to {}".format(f.name))
+                if not m:
+                    assert not line.strip(), line
+                    continue
+                name1, name2, tokens, lines, t1, t2, l1, l2, regions = m.groups()
+                yield name1, name2, int(tokens), int(lines), \
+                      (int(t1), int(t2), int(l1), int(l2)), regions
+
+    def _parse_results(self, file, submit_fn, pair_fn, limit=None):
+        """ Parse a results file.
+            submit_fn: Called with (name, total tokens, total lines) of both submissions
+            pair_fn: Called with (name1, name2, tokens, lines, regions)
+            limit: Stop after this many results (default: all)
+        """
+        for name1, name2, tokens, lines, counts, regions in \
+                itertools.islice(self._iter_results(file), limit):
+            if submit_fn:
+                submit_fn(name1, counts[0], counts[2])
+                submit_fn(name2, counts[1], counts[3])
+            if pair_fn: pair_fn(name1, name2, tokens, lines, self._parse_regions(regions))
 
     def _run_common(self):
+        runs = []
         for i, p in enumerate(self.pairs):
-            manifest, results = ("%s.%d" % (s, i) for s in ("manifest", "results"))
+            manifest, results = (os.path.join(self.tmpdir, "%s.%d" % (s, i)) for s in ("manifest", "results"))
             self._gen_manifest(manifest, p)
-            self._exec(self.NOBASE_THRESHOLD, manifest, results)
+            runs.append((manifest, results))
+        # the pairs' backend runs are independent, so let the backend batch them
+        self.backend.run_all(self.NOBASE_THRESHOLD, runs)
+        for p, (_, results) in zip(self.pairs, runs):
             fn = lambda *args: self._update_nobase(p, *args)
             self._parse_results(results, self._update_submit, fn)
     
@@ -198,7 +262,7 @@ class Runner(object):
         # token_other, token_fname,
         #     token_t, token_tc, token_po, token_ps
         for i, p in enumerate(self.fname_pairs.values()):
-          manifest, results = ("%s.%d" % (s, i) for s in ("manifest", "results"))
+          manifest, results = (os.path.join(self.tmpdir, "%s.%d" % (s, i)) for s in ("manifest", "results"))
           self._gen_manifest(manifest, p)
           self._exec(self.NOBASE_THRESHOLD, manifest, results)
           fn = lambda *args: self._update_nobase(p, *args)
@@ -220,7 +284,7 @@ class Runner(object):
             match_tokens[uname][6:] = [uname_fname, other_fname,
                 t, tc, po, ps]
         print("finished parsing", len(match_tokens.keys()), "unames")
-        with open(os.path.join(os.getcwd(),'matches.csv'), 'w') as f:
+        with open(os.path.join(self.tmpdir,'matches.csv'), 'w') as f:
           f.write('\n'.join([
                 ','.join([uname] + list(map(str, match_tokens[uname]))) \
               for uname in sorted(match_tokens.keys())]))
@@ -239,16 +303,8 @@ class Runner(object):
         # MOSS counts trailing \n as separate line
         assert s.lines == lines - 1, name
 
-    @classmethod
-    def _exec(cls, threshold, manifest, results):
-        # These options were hard-coded in the Perl script (some were vars but not user-settable).
-        MAGIC_ARGS = ["-p", "24", "-t", "26", "-g", "10", "-w", "5"]
-
-        args = ["-n", str(threshold), "-a", manifest, "-o", results]
-        with open(os.devnull, "w") as NULL:
-            proc = subprocess.Popen([cls.BINARY] + MAGIC_ARGS + args, stdout=NULL, stderr=subprocess.PIPE)
-        errors = proc.communicate()[1].strip()
-        if errors: raise RuntimeError("MOSS errors:\n%s" % errors)
+    def _exec(self, threshold, manifest, results):
+        self.backend.run(threshold, manifest, results)
 
 # vim: et sw=4 ts=4
 
@@ -0,0 +1,11 @@
+$(function() {
+    $(".regions a").click(function() {
+        var region = $(this).data("region");
+        for (var i = 0; i < 2; i++) {
+            var file = $("#file" + i);
+            var target = $("#region" + i + "_" + region);
+            file.scrollTop(file.scrollTop() + target.position().top);
+        }
+        return false;
+    });
+});
@@ -5,7 +5,7 @@ Michael <mchang@cs>, 2015
 """
 
 from collections import namedtuple
-import functools, os, timeit
+import array, bisect, functools, itertools, os, timeit
 
 from . import config
 
@@ -14,18 +14,61 @@ STARTER, CURRENT, ARCHIVE, NTYPES = range(4)
 TYPE_STR = ["STARTER", "CURRENT", "ARCHIVE"]
 
 class MC(object):
+    __slots__ = ("match", "common")
     def __init__(self, m, c): self.match, self.common = m, c
     def __repr__(self): return "match=%d, common=%d" % (self.match, self.common)
 
+class Regions(object):
+    """ Compact list of matched regions (Range in s1, Range in s2, tokens), stored as
+        parallel array("i") columns instead of tuples. Regions are built as tuples
+        when accessed.
+    """
+    __slots__ = ("columns",)
+    COLUMNS = 5 # s1 start, s1 end, s2 start, s2 end, tokens
+
+    def __init__(self, regions=()):
+        self.columns = tuple(array.array("i") for _ in range(self.COLUMNS))
+        for (s1, e1), (s2, e2), t in regions:
+            for column, x in zip(self.columns, (s1, e1, s2, e2, t)): column.append(x)
+
+    @classmethod
+    def from_columns(cls, columns):
+        """ Build from COLUMNS sequences of ints (or int strings). """
+        regions = cls()
+        for column, values in zip(regions.columns, columns): column.extend(map(int, values))
+        return regions
+
+    def __len__(self): return len(self.columns[0])
+
+    def __getitem__(self, i):
+        s1, e1, s2, e2, t = self.columns
+        return (Range(s1[i], e1[i]), Range(s2[i], e2[i]), t[i])
+
+    def __iter__(self):
+        for s1, e1, s2, e2, t in itertools.izip(*self.columns):
+            yield (Range(s1, e1), Range(s2, e2), t)
+
+    def __eq__(self, other): return list(self) == list(other)
+    def __ne__(self, other): return not self == other
+    def __repr__(self): return "Regions(%r)" % list(self)
+
+    def by_tokens(self):
+        """ Returns a copy sorted by tokens (descending), then ranges. """
+        s1, e1, s2, e2, t = self.columns
+        order = sorted(range(len(self)), key=lambda i: (-t[i], s1[i], e1[i], s2[i], e2[i]))
+        return Regions.from_columns([column[i] for i in order] for column in self.columns)
+
 class Pair(object):
+    __slots__ = ("submits", "is_self", "tokens", "match", "regions", "percent")
     COMMON = -2
 
     def __init__(self, s1, s2, tokens, regions):
         self.submits = (s1, s2)
         self.is_self = (s1.student() == s2.student())
         self.tokens = MC(tokens, 0)
-        # list of (Range(s1.start, s1.end), Range(s2.start, s2.end), tokens)
-        self.match = sorted(regions, key=lambda x:(-x[2], x[0], x[1]))
+        # Regions of (Range(s1.start, s1.end), Range(s2.start, s2.end), tokens)
+        if not isinstance(regions, Regions): regions = Regions(regions)
+        self.match = regions.by_tokens()
         # For each submission: list of (range, index), index is idx into match or COMMON
         self.regions = None
         self.percent = None
@@ -33,6 +76,28 @@ class Pair(object):
     def __repr__(self):
         return "Pair(%s, %s, %s)" % (self.submits[0].name, self.submits[1].name, repr(self.tokens))
 
+    def get_state(self):
+        """ Everything a report needs, as plain (JSON-serializable) data. """
+        return {"submits": [(s.type, s.idx, s.name, s.tokens, s.lines) for s in self.submits],
+                "tokens": (self.tokens.match, self.tokens.common),
+                "match": list(self.match), "regions": self.regions, "percent": self.percent}
+
+    @classmethod
+    def from_state(cls, state):
+        """ Rebuild a Pair from get_state(). """
+        submits = []
+        for type, idx, name, tokens, lines in state["submits"]:
+            s = Submit(type, idx, str(name))
+            s.tokens, s.lines = tokens, lines
+            submits.append(s)
+        match = [(Range(*r1), Range(*r2), t) for r1, r2, t in state["match"]]
+        p = cls(submits[0], submits[1], state["tokens"][0], match)
+        p.tokens.common = state["tokens"][1]
+        if state["regions"] is not None:
+            p.regions = tuple([(Range(*r), i) for r, i in regions] for regions in state["regions"])
+        if state["percent"] is not None: p.percent = tuple(str(x) for x in state["percent"])
+        return p
+
     def calc_percent(self):
         assert self.percent is None
         fn = lambda s: float(self.tokens.match) / (s.tokens - self.tokens.common)
@@ -43,30 +108,49 @@ class Pair(object):
         assert self.regions is None
         self.tokens.common = max(tokens - self.tokens.match, 0)
 
-        regions = ([], [])
-        for sub in range(2):
-            lines = [-1 for _ in range(self.submits[sub].lines + 1)]
-            for r in nobase:
-                for l in range(r[sub].start, r[sub].end + 1): lines[l] = self.COMMON
-            for i, r in enumerate(self.match):
-                for l in range(r[sub].start, r[sub].end + 1): lines[l] = i
-            start = 0
-            cur = -1
-            for i, v in enumerate(lines):
-                if v == cur: continue
-                if cur != -1: regions[sub].append((Range(start, i - 1), cur))
-                cur = v
-                start = i
-        self.regions = regions
+        # matches are painted over common code, later regions over earlier ones
+        layers = [(r, self.COMMON) for r in nobase] + [(r, i) for i, r in enumerate(self.match)]
+        self.regions = tuple(self._paint(self.submits[sub].lines + 1, [(r[sub], v) for r, v in layers])
+                             for sub in range(2))
+
+    @staticmethod
+    def _paint(n, layers):
+        """ Returns the runs of lines 0..n-1 by topmost covering layer, as (Range, value).
+            layers: List of (Range, value), each painted over the previous ones
+            Layers are applied top-down as intervals, keeping only the parts not
+            yet covered, instead of painting line by line.
+            Uncovered runs and the run that ends the file are left out.
+        """
+        edges = [] # sorted boundaries of covered [start, end + 1) intervals
+        pieces = []
+        for (start, end), v in reversed(layers):
+            a, b = max(start, 0), min(end + 1, n)
+            if a >= b: continue
+            i, j = bisect.bisect_right(edges, a), bisect.bisect_left(edges, b)
+            # uncovered parts of [a, b) lie between covered intervals in edges[i:j]
+            inner = ([a] if i % 2 == 0 else []) + edges[i:j] + ([b] if j % 2 == 0 else [])
+            pieces.extend((inner[k], inner[k + 1], v) for k in range(0, len(inner), 2)
+                          if inner[k] < inner[k + 1])
+            edges[i:j] = ([a] if i % 2 == 0 else []) + ([b] if j % 2 == 0 else [])
+        pieces.sort()
+        runs = [] # [start, end + 1, value]
+        for a, b, v in pieces:
+            if runs and runs[-1][1] == a and runs[-1][2] == v: runs[-1][1] = b
+            else: runs.append([a, b, v])
+        if runs and runs[-1][1] == n: runs.pop()
+        return [(Range(a, b - 1), v) for a, b, v in runs]
 
 @functools.total_ordering
 class Submit(object):
+    __slots__ = ("type", "idx", "name", "batch", "tokens", "lines")
     ARCHIVE_SET = 1000000
+    BATCH_SET = ARCHIVE_SET - 1
 
-    def __init__(self, type, idx, name):
+    def __init__(self, type, idx, name, batch=None):
         self.type = type
         self.idx = idx
         self.name = name
+        self.batch = batch # batched submissions are only compared to other types
         self.tokens = -1
         self.lines = -1
 
@@ -78,11 +162,17 @@ class Submit(object):
                (TYPE_STR[self.type], self.idx, self.name, self.tokens, self.lines)
 
     def manifest_line(self, lang, id=None):
+        if id is None and self.batch is not None: id = self.BATCH_SET
         if id is None: id = [0, self.idx + 1, self.ARCHIVE_SET][self.type] # idx is 0-indexed
         return "%s %d %s %s\n" % (self.tmpfile(), id, lang, self.name)
 
     def student(self):
-        base = os.path.basename(self.name)
+        return Submit.student_of(self.name)
+
+    @staticmethod
+    def student_of(name):
+        """ Student of a submission name (pairs of the same student are self pairs). """
+        base = os.path.basename(name)
         # NOTE(Lisa): changed to find, not rfind
         return base[:base.find("_")] if config.HAS_SUBMIT_NUM and "_" in base else base
 
@@ -95,9 +185,10 @@ def time(msg, fn):
     msg_wait = "--- " + msg + " ... "
     print msg_wait + "\r" , # trailing comma suppresses newline
     start = timeit.default_timer()
-    fn()
+    result = fn()
     end = timeit.default_timer()
     print "%s done (%.3f s)\r" % (msg_wait, end - start) , 
+    return result
 
 # vim: et sw=4 ts=4
 
@@ -1,9 +1,20 @@
-from util import set_global_course_counts
-from tmoss import tmoss
+from util import set_global_course_counts, cpu_count
+from tmoss import tmoss_all, write_reports
 from argparse import ArgumentParser
 import os
 
 parser = ArgumentParser(description="TMOSS Algorithm")
+parser.add_argument('command',
+        nargs='?',
+        choices=['run', 'report'],
+        help="run: compute top matches (default). " + \
+             "report: write html reports of the given students' top matches.",
+        default='run')
+
+parser.add_argument('students',
+        nargs='*',
+        help="Students to report on (report command only).")
+
 parser.add_argument('--data', '-d',
         type=str,
         help="Directory of student repositories sorted by course",
@@ -36,15 +47,80 @@ parser.add_argument('--extension', '-ext',
         help="Student code extension type.",
         default="java")
 
+parser.add_argument('--backend',
+        choices=['moss', 'winnow'],
+        help="Similarity backend: the MOSS binary at bin/moss, " + \
+             "or the in-process winnowing engine.",
+        default="moss")
+
+parser.add_argument('--prefilter',
+        type=int,
+        help="Only compare each snapshot file against this many archive " + \
+             "submissions, picked with a fingerprint index (0: compare all).",
+        default=0)
+
+parser.add_argument('--git-reader',
+        choices=['python', 'subprocess'],
+        help="Read student repositories in-process (python: loose objects " + \
+             "and pack files) or through a `git cat-file` subprocess.",
+        default='python')
+
+parser.add_argument('--sample-delta',
+        type=int,
+        help="Skip snapshots whose code changed by fewer than this many " + \
+             "lines since the last scored one, then score densely around " + \
+             "score peaks (0: score every snapshot).",
+        default=0)
+
 parser.add_argument('--temp', '-temp',
         type=str,
         help="Temp workspace directory.",
         default="temp")
 
+parser.add_argument('--batch-size', '-b',
+        type=int,
+        help="Number of snapshots scored per backend run.",
+        default=1)
+
+parser.add_argument('--moss-output',
+        choices=['keep', 'copy', 'move', 'link'],
+        help="How backend runs save their workspace for reports: keep it in " + \
+             "place, or copy it / move or hardlink only report files.",
+        default="keep")
+
+parser.add_argument('--html-top',
+        type=int,
+        help="Number of best snapshots per student to write html reports " + \
+             "for while running (0: none, use the report command).",
+        default=1)
+
+parser.add_argument('--html-assets',
+        choices=['shared', 'inline'],
+        help="Link jQuery and the stylesheet from out/<course>/static " + \
+             "(shared) or embed them in every html report (inline).",
+        default='shared')
+
+parser.add_argument('--html-gzip',
+        help="Write html reports gzip-compressed (.html.gz).",
+        action='store_true')
+
 parser.add_argument('--multithread', '-m',
-        help="Turn on multiprocessing",
+        help="Turn on multiprocessing with one job per CPU (see --jobs).",
         action='store_true')
+
+parser.add_argument('--jobs', '-j',
+        type=int,
+        help="Number of worker processes.",
+        default=1)
+
+parser.add_argument('--chunk-size',
+        type=int,
+        help="With several jobs, split students into tasks of at most " + \
+             "this many snapshots (0: one task per student).",
+        default=50)
 args = parser.parse_args()
+if args.multithread and args.jobs == 1:
+  args.jobs = cpu_count()
 
 def get_course_dirs(args):
   course_dirs = []
@@ -59,5 +135,7 @@ def get_course_dirs(args):
 if __name__ == "__main__":
   course_dirs = get_course_dirs(args)
   set_global_course_counts(course_dirs)
-  for course_dir in course_dirs:
-    tmoss(course_dir, args)
+  if args.command == 'report':
+    write_reports(course_dirs, args.students, args)
+  else:
+    tmoss_all(course_dirs, args)
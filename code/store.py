@@ -0,0 +1,232 @@
+from util import *
+import hashlib, json, sqlite3, zlib
+
+"""
+Per-course SQLite store of snapshot results and student top matches.
+
+out/
+  2012_1/
+    results.db      # snapshots(student, snapshot, other, score)
+                    # top_matches(student, other, snapshot, score)
+                    # reports(student, snapshot, report): data to render html,
+                    #   also of scored files (snapshot: <snapshot>/<code dir>)
+                    # sources(hash, source): submission contents of reports
+                    # progress(student, last_commit): processed HEAD (full hash)
+                    # skipped(student, snapshot): not scored by sampling yet
+    top_matches.csv # exported from results.db
+
+Results are buffered and inserted in batched transactions. Every process
+gets its own connection (see get_result_store).
+"""
+RESULTS_DB = 'results.db'
+BATCH_SIZE = 100 # buffered results per transaction
+TIMEOUT = 60     # seconds to wait for another process's transaction
+
+_stores = {}
+def get_result_store(course_dir, out_dir):
+  coursename = os.path.basename(os.path.normpath(course_dir))
+  path = os.path.join(out_dir, coursename, RESULTS_DB)
+  store = _stores.get(path)
+  if not store or store.pid != os.getpid():
+    store = ResultStore(path)
+    _stores[path] = store
+  return store
+
+class ResultStore(object):
+  def __init__(self, path):
+    self.path = path
+    self.pid = os.getpid()
+    self.pending = []
+    self.pending_reports = []
+    self.pending_copies = [] # (student, from snapshot, to snapshot)
+    self.pending_sources = [] # (hash, compressed source)
+    self.pending_skipped = [] # (student, snapshot)
+    self.source_hashes = None # sources stored or buffered, loaded on first use
+    out_dir = os.path.dirname(path)
+    if out_dir and not os.path.exists(out_dir):
+      os.makedirs(out_dir)
+    self.conn = sqlite3.connect(path, timeout=TIMEOUT)
+    self.conn.execute('PRAGMA journal_mode=WAL')
+    with self.conn:
+      self.conn.execute('CREATE TABLE IF NOT EXISTS snapshots (' +
+          'student TEXT, snapshot TEXT, other TEXT, score NUMERIC, ' +
+          'PRIMARY KEY (student, snapshot))')
+      self.conn.execute('CREATE TABLE IF NOT EXISTS top_matches (' +
+          'student TEXT PRIMARY KEY, other TEXT, snapshot TEXT, score NUMERIC)')
+      self.conn.execute('CREATE TABLE IF NOT EXISTS reports (' +
+          'student TEXT, snapshot TEXT, report BLOB, ' +
+          'PRIMARY KEY (student, snapshot))')
+      self.conn.execute('CREATE TABLE IF NOT EXISTS sources (' +
+          'hash TEXT PRIMARY KEY, source BLOB)')
+      self.conn.execute('CREATE TABLE IF NOT EXISTS progress (' +
+          'student TEXT PRIMARY KEY, last_commit TEXT)')
+      self.conn.execute('CREATE TABLE IF NOT EXISTS skipped (' +
+          'student TEXT, snapshot TEXT, PRIMARY KEY (student, snapshot))')
+
+  """
+  Buffers a snapshot result. An existing
+  result for the same snapshot is kept.
+  """
+  def add(self, result):
+    self.pending.append(result)
+    if len(self.pending) >= BATCH_SIZE:
+      self.flush()
+
+  """
+  Buffers the report data of a result (see Result.get_report).
+  Submission contents are stored (and compressed) once per distinct content.
+  """
+  def add_report(self, student, snapshot, report):
+    if self.source_hashes is None:
+      self.source_hashes = set(from_sql(row[0]) for row in
+          self.conn.execute('SELECT hash FROM sources'))
+    source_hashes = []
+    for source in report['sources']:
+      source_hash = hashlib.sha1(source).hexdigest()
+      if source_hash not in self.source_hashes:
+        self.source_hashes.add(source_hash)
+        self.pending_sources.append((source_hash, zlib.compress(source)))
+      source_hashes.append(source_hash)
+    report = dict(report, sources=source_hashes)
+    self.pending_reports.append((student, snapshot,
+        zlib.compress(json.dumps(report))))
+
+  """
+  Buffers a copy of a stored (or buffered) report under another snapshot.
+  """
+  def copy_report(self, student, from_snapshot, to_snapshot):
+    self.pending_copies.append((student, from_snapshot, to_snapshot))
+
+  """
+  Buffers a snapshot left unscored by sampling (see get_skipped).
+  """
+  def add_skipped(self, student, snapshot):
+    self.pending_skipped.append((student, snapshot))
+
+  def flush(self):
+    if not self.pending and not self.pending_reports and \
+        not self.pending_copies and not self.pending_sources and \
+        not self.pending_skipped:
+      return
+    with self.conn:
+      self.conn.executemany('INSERT OR IGNORE INTO snapshots ' +
+          '(student, other, snapshot, score) VALUES (?, ?, ?, ?)',
+          [result.get_tuple() for result in self.pending])
+      self.conn.executemany('INSERT OR IGNORE INTO skipped ' +
+          '(student, snapshot) VALUES (?, ?)', self.pending_skipped)
+      # skipped snapshots are done once scored
+      self.conn.executemany('DELETE FROM skipped ' +
+          'WHERE student = ? AND snapshot = ?',
+          [(result.get_student(), result.get_snapshot()) \
+              for result in self.pending])
+      # another process may have stored the same source meanwhile
+      self.conn.executemany('INSERT OR IGNORE INTO sources ' +
+          '(hash, source) VALUES (?, ?)',
+          [(source_hash, sqlite3.Binary(source)) \
+              for source_hash, source in self.pending_sources])
+      self.conn.executemany('INSERT OR REPLACE INTO reports ' +
+          '(student, snapshot, report) VALUES (?, ?, ?)',
+          [(student, snapshot, sqlite3.Binary(report)) \
+              for student, snapshot, report in self.pending_reports])
+      self.conn.executemany('INSERT OR REPLACE INTO reports ' +
+          '(student, snapshot, report) SELECT student, ?, report ' +
+          'FROM reports WHERE student = ? AND snapshot = ?',
+          [(to_snapshot, student, from_snapshot) \
+              for student, from_snapshot, to_snapshot in self.pending_copies])
+    self.pending = []
+    self.pending_reports = []
+    self.pending_copies = []
+    self.pending_sources = []
+    self.pending_skipped = []
+
+  def get(self, student, snapshot):
+    row = self.conn.execute('SELECT student, snapshot, score, other ' +
+        'FROM snapshots WHERE student = ? AND snapshot = ?',
+        (student, snapshot)).fetchone()
+    if not row:
+      return None
+    return Result(*map(from_sql, row))
+
+  """
+  Returns a dictionary of snapshot -> Result for a student.
+  """
+  def get_all(self, student):
+    rows = self.conn.execute('SELECT student, snapshot, score, other ' +
+        'FROM snapshots WHERE student = ?', (student,))
+    return dict((str(row[1]), Result(*map(from_sql, row))) \
+        for row in rows)
+
+  """
+  Returns the snapshots of a student skipped by sampling, oldest first.
+  """
+  def get_skipped(self, student):
+    rows = self.conn.execute('SELECT snapshot FROM skipped ' +
+        'WHERE student = ? ORDER BY snapshot', (student,))
+    return [from_sql(row[0]) for row in rows]
+
+  """
+  Returns the report data of a snapshot, or None.
+  """
+  def get_report(self, student, snapshot):
+    row = self.conn.execute('SELECT report FROM reports ' +
+        'WHERE student = ? AND snapshot = ?', (student, snapshot)).fetchone()
+    if not row:
+      return None
+    report = json.loads(zlib.decompress(str(row[0])))
+    sources = []
+    for source_hash in report['sources']:
+      source = self.conn.execute('SELECT source FROM sources WHERE hash = ?',
+          (source_hash,)).fetchone()[0]
+      sources.append(zlib.decompress(str(source)))
+    report['sources'] = sources
+    return report
+
+  """
+  Returns a student's k best snapshot results (earliest first on ties).
+  """
+  def get_top_results(self, student, k):
+    rows = self.conn.execute('SELECT student, snapshot, score, other ' +
+        'FROM snapshots WHERE student = ? ' +
+        'ORDER BY score DESC, snapshot LIMIT ?', (student, k))
+    return [Result(*map(from_sql, row)) for row in rows]
+
+  def set_top_match(self, result):
+    with self.conn:
+      self.conn.execute('INSERT OR REPLACE INTO top_matches ' +
+          '(student, other, snapshot, score) VALUES (?, ?, ?, ?)',
+          result.get_tuple())
+
+  def get_top_match(self, student):
+    row = self.conn.execute('SELECT student, snapshot, score, other ' +
+        'FROM top_matches WHERE student = ?', (student,)).fetchone()
+    if not row:
+      return None
+    return Result(*map(from_sql, row))
+
+  def set_last_commit(self, student, commit_hash):
+    with self.conn:
+      self.conn.execute('INSERT OR REPLACE INTO progress ' +
+          '(student, last_commit) VALUES (?, ?)', (student, commit_hash))
+
+  def get_last_commit(self, student):
+    row = self.conn.execute('SELECT last_commit FROM progress ' +
+        'WHERE student = ?', (student,)).fetchone()
+    return from_sql(row[0]) if row else None
+
+  def get_top_matches(self):
+    rows = self.conn.execute('SELECT student, snapshot, score, other ' +
+        'FROM top_matches ORDER BY student')
+    return [Result(*map(from_sql, row)) for row in rows]
+
+  """
+  Writes all top matches as a csv in the top_matches.csv format:
+    student_name,matched_student,snapshot_time_and_name,similarity_score
+  """
+  def export_top_matches(self, fpath):
+    write_csv(fpath, [result.get_tuple() \
+        for result in self.get_top_matches()])
+    return fpath
+
+# sqlite returns TEXT as unicode
+def from_sql(value):
+  return str(value) if isinstance(value, unicode) else value
@@ -1,6 +1,8 @@
 from util import *
+from store import get_result_store
 import moss_interface
 import git_interface
+import collections
 
 class Student(object):
   def __init__(self, student, course_dir, args):
@@ -13,62 +15,91 @@ class Student(object):
     coursename = os.path.basename(os.path.normpath(self.course_dir))
     self.out_student_dir = os.path.join(args.out, coursename,
                               self.student)
-    self.top_match_path = os.path.join(self.out_student_dir, TOP_MATCHES)
+    self.assets_dir = None # static files shared by the course's reports
+    if args.html_assets == 'shared':
+      self.assets_dir = os.path.join(args.out, coursename, STATIC_DIR)
+    self.html_gzip = args.html_gzip
+    self.store = get_result_store(course_dir, args.out)
+    self.stored = None # snapshot -> Result, loaded on first use
     self.extension = args.extension
+    self.git_reader = args.git_reader
     self.matches = {}
+    self.snapshot_keys = {} # snapshot -> content key
+    self.scored = {}        # content key -> Result
+    self.snapshot_files = {} # snapshot -> {code file name: blob hash}
+    self.blob_lines = {}     # blob hash -> Counter of its lines
+    self.file_scored = {}    # (file name, blob hash) -> (Result, report key)
 
   def get_name(self):
     return self.student
 
   """
-  Returns a list of directories, where each
-  directory corresponds to a student snapshot.
+  Returns the student's commits as "hash timestamp" strings, newest first.
   """
-  def setup_repository(self):
-    counter = course_counts[self.course_dir]
-    student_i = counter.get()
-    num_students = counter.get_total()
-    print "Student {}/{} {} setting up snapshot repository ...".format(
-      student_i, num_students, self.student)
-    if os.path.exists(self.repo_dir):
-      self.snapshots = [os.path.join(self.repo_dir, snapshot) \
-          for snapshot in os.listdir(self.repo_dir)]
-      return
-    git_interface.git_master(self.student_dir) # prepare
-  
+  def get_commits(self):
+    reader = git_interface.open_reader(self.student_dir, self.git_reader)
+    try:
+      return reader.list_commits()
+    finally:
+      reader.close()
+
+  """
+  Exports a directory for each of the given commits (default: all),
+  where each directory corresponds to a student snapshot.
+  label: progress label of the student (see get_student_tasks)
+  """
+  def setup_repository(self, commits=None, label=None):
+    if label is None:
+      label = "Student {}".format(self.student)
+    print "{} setting up snapshot repository ...".format(label)
     # snapshot "hash timestamp"
-    all_snapshots = git_interface.git_log(
-                          git_dir=self.student_dir, format_str="%h %ct"
-                          ).split('\n')
+    all_snapshots = commits if commits is not None else self.get_commits()
     self.snapshots = [0]*len(all_snapshots)
+    reader = git_interface.open_reader(self.student_dir, self.git_reader)
     for j, snapshot in enumerate(all_snapshots):
       snapshot_hash, snapshot_posix = snapshot.split(' ')
       human_time = posix_to_datetime(int(snapshot_posix))
       sys.stdout.write('{}/{} {} snapshot {} ({})\r'.format(
         j+1, len(all_snapshots), self.student_dir, snapshot_hash, human_time))
       sys.stdout.flush()
-      snapshot_dir = git_interface.git_checkout(snapshot,
-          orig_dir=self.student_dir, target_dir=self.repo_dir,
-          prefix=self.student)
+      snapshot_dir, files = git_interface.git_export(snapshot, reader,
+          target_dir=self.repo_dir, prefix=self.student,
+          match_fn=self.is_code_file)
       self.setup_snapshot(snapshot_dir)
       self.snapshots[j] = snapshot_dir
+      self.snapshot_keys[os.path.basename(snapshot_dir)] = \
+          moss_interface.snapshot_key(files, self.extension)
+      self.snapshot_files[os.path.basename(snapshot_dir)] = dict(files)
+    reader.close()
     sys.stdout.write('\n')
     sys.stdout.flush()
 
-    git_interface.git_master(self.student_dir) # reset
+  """
+  Returns the content key of each of the given commits (see
+  moss_interface.snapshot_key), read without exporting them.
+  """
+  def get_commit_keys(self, commits):
+    reader = git_interface.open_reader(self.student_dir, self.git_reader)
+    try:
+      return [moss_interface.snapshot_key([(fname, blob_hash) \
+          for fname, blob_hash in reader.list_files(commit.split(' ')[0]) \
+          if self.is_code_file(fname)], self.extension) \
+          for commit in commits]
+    finally:
+      reader.close()
+
+  def is_code_file(self, fname):
+    return fname.endswith(self.extension)
 
   """
   Separate directories for each java file.
   """
   def setup_snapshot(self, snapshot_dir):
     code_files = [fname for fname in os.listdir(snapshot_dir) \
-        if fname.endswith(self.extension)]
+        if self.is_code_file(fname)]
     code_dirs = []
     for j, code_fname in enumerate(code_files):
-      # remove all underscores
-      code_newname = ''.join(code_fname.split('.')[0].split('_'))
-      code_dir = os.path.join(snapshot_dir,
-                '%s_%s' % (self.student,code_newname))
+      code_dir = self.get_code_dir(snapshot_dir, code_fname)
       if os.path.exists(code_dir):
         shutil.rmtree(code_dir)
       os.mkdir(code_dir)
@@ -78,38 +109,237 @@ class Student(object):
       code_dirs.append(code_dir)
     return code_dirs
 
+  def get_code_dir(self, snapshot_dir, code_fname):
+    # remove all underscores
+    code_newname = ''.join(code_fname.split('.')[0].split('_'))
+    return os.path.join(snapshot_dir, '%s_%s' % (self.student, code_newname))
+
+  """
+  Number of code lines added or removed between two exported snapshots,
+  ignoring moved lines. Only files whose blobs differ are read.
   """
-  Saves match to a dictionary.
-  Also saves match to an html output to look at later.
+  def get_snapshot_delta(self, snapshot_dir1, snapshot_dir2):
+    files1 = self.snapshot_files[os.path.basename(snapshot_dir1)]
+    files2 = self.snapshot_files[os.path.basename(snapshot_dir2)]
+    delta = 0
+    for fname in set(files1) | set(files2):
+      blob1, blob2 = files1.get(fname), files2.get(fname)
+      if blob1 == blob2: continue
+      lines1 = self.get_blob_lines(snapshot_dir1, fname, blob1)
+      lines2 = self.get_blob_lines(snapshot_dir2, fname, blob2)
+      delta += sum((lines1 - lines2).values()) + \
+          sum((lines2 - lines1).values())
+    return delta
+
+  def get_blob_lines(self, snapshot_dir, fname, blob_hash):
+    if blob_hash is None:
+      return collections.Counter()
+    if blob_hash not in self.blob_lines:
+      path = os.path.join(self.get_code_dir(snapshot_dir, fname), fname)
+      with open(path) as f:
+        self.blob_lines[blob_hash] = collections.Counter(
+            line.strip() for line in f if line.strip())
+    return self.blob_lines[blob_hash]
+
+  """
+  Saves match to a dictionary and to the course's result store.
+  Only the match's summary is kept, so its pair and workspace can be freed.
   """
   def record_match(self, result):
-    self.matches[result.get_snapshot()] = result
-    result.write_csv(self.out_student_dir)
-    result.write_html(self.out_student_dir)
+    snapshot = result.get_snapshot()
+    result = result.get_summary()
+    self.matches[snapshot] = result
+    if snapshot in self.snapshot_keys:
+      self.scored.setdefault(self.snapshot_keys[snapshot], result)
+    if snapshot not in self.get_stored():
+      self.store.add(result)
+
+  """
+  (file name, blob hash) of the files of a snapshot not scored in an
+  earlier snapshot (see record_files).
+  """
+  def get_unscored_files(self, snapshot_dir):
+    snapshot = os.path.basename(os.path.normpath(snapshot_dir))
+    return set(key for key in self.snapshot_files[snapshot].items() \
+        if key not in self.file_scored)
+
+  """
+  Code dirs of a snapshot other than those of the given files.
+  """
+  def get_other_code_dirs(self, snapshot_dir, files):
+    snapshot = os.path.basename(os.path.normpath(snapshot_dir))
+    return set(os.path.basename(self.get_code_dir(snapshot_dir, fname)) \
+        for fname, blob_hash in self.snapshot_files[snapshot].items() \
+        if (fname, blob_hash) not in files)
+
+  """
+  Records a snapshot's match, assembled from the best result of each of
+  its files: results of the files just scored, and the cached results
+  of files unchanged since an earlier snapshot. The report of each newly
+  scored file's best result is stored once, under <snapshot>/<code dir>,
+  and its summary is cached by blob hash; the snapshot shares the report
+  of its best file.
+  """
+  def record_files(self, snapshot_dir, results):
+    snapshot = os.path.basename(os.path.normpath(snapshot_dir))
+    files = sorted(self.snapshot_files[snapshot].items())
+    for fname, blob_hash in files:
+      if (fname, blob_hash) in self.file_scored: continue
+      code_dirname = os.path.basename(self.get_code_dir(snapshot_dir, fname))
+      file_results = [result for result in results \
+          if result.get_file() == code_dirname]
+      scored = None
+      if file_results:
+        best = max(file_results, key=lambda result: result.get_score())
+        report_key = '%s/%s' % (snapshot, code_dirname)
+        self.store.add_report(self.student, report_key, best.get_report())
+        scored = (best.get_summary(), report_key)
+      self.file_scored[(fname, blob_hash)] = scored
+    scored = [self.file_scored[key] for key in files if self.file_scored[key]]
+    if not scored:
+      self.record_match(Result(self.student, snapshot))
+      return
+    result, report_key = max(scored, key=lambda (result, _): result.get_score())
+    self.record_match(result.for_snapshot(snapshot))
+    self.store.copy_report(self.student, report_key, snapshot)
+
+  """
+  Records the match of a snapshot whose code is identical to an
+  already-scored one (see load_duplicate), sharing its report.
+  """
+  def record_duplicate(self, snapshot_dir):
+    result = self.load_duplicate(snapshot_dir)
+    original = self.scored[self.get_snapshot_key(snapshot_dir)]
+    self.record_match(result)
+    self.store.copy_report(self.student, original.get_snapshot(),
+                           result.get_snapshot())
+
+  """
+  Records snapshots whose code is identical to an original snapshot
+  scored in another task, given as (snapshot, original snapshot) pairs,
+  sharing the original's result and report. Duplicates of a snapshot
+  skipped by sampling are recorded as skipped.
+  Returns the number of snapshots recorded with a result.
+  """
+  def record_duplicate_snapshots(self, duplicates):
+    self.store.flush()
+    num_recorded = 0
+    for snapshot, original in duplicates:
+      result = self.store.get(self.student, original)
+      if not result:
+        self.store.add_skipped(self.student, snapshot)
+        continue
+      self.store.add(result.for_snapshot(snapshot))
+      self.store.copy_report(self.student, original, snapshot)
+      num_recorded += 1
+    self.store.flush()
+    return num_recorded
+
+  """
+  Writes html reports for the student's k best snapshots.
+  """
+  def write_reports(self, k):
+    self.store.flush()
+    return [fdest for fdest in (self.write_report(result.get_snapshot()) \
+        for result in self.store.get_top_results(self.student, k)) if fdest]
+
+  def write_report(self, snapshot):
+    report = self.store.get_report(self.student, snapshot)
+    if not report:
+      return None
+    return moss_interface.write_report(report, snapshot, self.out_student_dir,
+      assets_dir=self.assets_dir, compress=self.html_gzip)
 
   def load_match(self, snapshot_dir):
     snapshot = os.path.basename(os.path.normpath(snapshot_dir))
-    return Result.load_csv(self.out_student_dir, snapshot)
+    return self.get_stored().get(snapshot)
+
+  def get_stored(self):
+    if self.stored is None:
+      self.stored = self.store.get_all(self.student)
+    return self.stored
+
+  def get_snapshot_key(self, snapshot_dir):
+    snapshot = os.path.basename(os.path.normpath(snapshot_dir))
+    return self.snapshot_keys.get(snapshot)
+
+  """
+  Returns the result of an already-scored snapshot with the same
+  code as snapshot_dir, or None.
+  """
+  def load_duplicate(self, snapshot_dir):
+    snapshot = os.path.basename(os.path.normpath(snapshot_dir))
+    result = self.scored.get(self.get_snapshot_key(snapshot_dir))
+    if not result:
+      return None
+    return result.for_snapshot(snapshot)
 
   def get_matches(self):
     return [self.matches[snapshot] \
         for snapshot in sorted(self.matches.keys())]
 
+  def get_match(self, snapshot_dir):
+    snapshot = os.path.basename(os.path.normpath(snapshot_dir))
+    return self.matches.get(snapshot)
+
   def is_match_computed(self, snapshot_dir):
     snapshot = os.path.basename(os.path.normpath(snapshot_dir))
     return snapshot in self.matches
 
   def save_top_match(self, top_match):
-    write_csv(self.top_match_path, [top_match.get_tuple()])
+    self.store.set_top_match(top_match)
 
   def get_top_match(self):
-    if not os.path.exists(self.top_match_path):
-      return None
-    with open(self.top_match_path, 'r') as f:
-      line = f.readline()
-      return Result.parse_line(line)
+    return self.store.get_top_match(self.student)
+
+  """
+  Returns (HEAD commit, commits added since the last processed commit).
+  The HEAD commit is a full hash, or None without a valid repository.
+  New commits are those not reachable from the last processed one
+  (`last..HEAD`), newest first; all commits if it is no longer in the
+  repository.
+  """
+  def get_new_commits(self):
+    last_commit = self.store.get_last_commit(self.student)
+    reader = git_interface.open_reader(self.student_dir, self.git_reader)
+    try:
+      head = reader.resolve('HEAD')
+      if last_commit:
+        # full hash of the stored one (earlier runs stored abbreviated hashes)
+        last_commit = reader.resolve(last_commit)
+      return head, reader.list_commits(last_commit)
+    finally:
+      reader.close()
+
+  """
+  Returns the commits of the snapshots skipped by sampling in earlier
+  runs (see record_skipped) that are still in the repository.
+  """
+  def get_skipped_commits(self):
+    skipped = self.store.get_skipped(self.student)
+    if not skipped:
+      return []
+    reader = git_interface.open_reader(self.student_dir, self.git_reader)
+    try:
+      commits = map(git_interface.snapshot_commit, skipped)
+      return [commit for commit in commits \
+          if reader.resolve(commit.split(' ')[0])]
+    finally:
+      reader.close()
+
+  """
+  Records a snapshot left unscored by sampling, so that a later run
+  scores it (see get_skipped_commits).
+  """
+  def record_skipped(self, snapshot_dir):
+    snapshot = os.path.basename(os.path.normpath(snapshot_dir))
+    self.store.add_skipped(self.student, snapshot)
+
+  def set_last_commit(self, commit_hash):
+    self.store.set_last_commit(self.student, commit_hash)
 
   def cleanup(self):
+    self.store.flush()
     if os.path.exists(self.repo_dir):
       sys.stdout.write("{}: Removing expanded student repo ({})...\n".format(
         self.student, self.repo_dir))
@@ -1,7 +1,11 @@
 from util import *
-from moss_interface import compute_similarity, cleanup_similarity_workspace
+from moss_interface import compute_similarity_batch, cleanup_similarity_workspace, \
+    prepare_archive
 import git_interface
+import pymoss
+from multiprocessing.pool import ThreadPool
 from student import Student
+from store import get_result_store
 
 """
 Main TMOSS file.
@@ -18,6 +22,13 @@ def get_compare_set(course_dir, args):
   final_submissions_dir = setup_final_submissions(course_dir, args)
   return final_submissions_dir, online_dir
 
+"""
+Serializes (and indexes) the archive of a compare set once,
+before any workers start.
+"""
+def prepare_compare_set(compare_set, args):
+  prepare_archive(args.extension, compare_set, args)
+
 """
 One file per directory, otherwise moss similarity scores will be off.
 
@@ -31,44 +42,105 @@ studentdir_fileone/
   file_one.java
 studentdir_filetwopointfive/
   file_two_point_five.java
+
+Files are read from each student's master commit, in parallel over
+--jobs workers, without checking out or changing the student repos.
+The master commit and directories of each student are recorded in
+FINAL_HEADS, so re-running after a data refresh only rewrites the
+students whose master moved, and removes the students no longer in the
+course. A directory without FINAL_HEADS is rebuilt from scratch.
 """
 def setup_final_submissions(course_dir, args):
-  course_dir = course_dir.strip('/')
-  course_name = course_dir.split('/')[-1]
-  data_dir = '/'.join(course_dir.split('/')[:-1])
+  course_dir = os.path.normpath(course_dir)
+  course_name = os.path.basename(course_dir)
+  data_dir = os.path.dirname(course_dir)
   final_submissions_dir = os.path.join(data_dir,
       '%s_%s' % (args.final_submissions, course_name))
-  if os.path.exists(final_submissions_dir):
-    print "Already exists: {}".format(final_submissions_dir)
-    return final_submissions_dir
-  os.mkdir(final_submissions_dir)
-  print "Preparing final submission directories. " + \
-      "This only needs to be done once."
-
-  git_interface.reset_all_to_master(course_dir)
-  for i, student in enumerate(os.listdir(course_dir)):
-    student_dir = os.path.join(course_dir, student)
-    if not os.path.isdir(student_dir): continue
-    student_newname = ''.join(student.split('_')) # remove underscores
-
-    code_files = [fname for fname in os.listdir(student_dir) \
-        if fname.endswith(args.extension)]
-    for j, code_fname in enumerate(code_files):
+  heads_path = os.path.join(final_submissions_dir, FINAL_HEADS)
+  heads = {} # student -> [master commit, code dirs]
+  if os.path.exists(heads_path):
+    with open(heads_path) as f:
+      heads = json.load(f)
+  else:
+    # unknown contents, e.g. an interrupted first run
+    if os.path.exists(final_submissions_dir):
+      print "Rebuilding {}".format(final_submissions_dir)
+      shutil.rmtree(final_submissions_dir)
+    os.mkdir(final_submissions_dir)
+
+  students = [student for student in sorted(os.listdir(course_dir)) \
+      if os.path.isdir(os.path.join(course_dir, student))]
+  removed = sorted(set(heads) - set(students))
+  for student in removed:
+    for code_dirname in heads.pop(student)[1]:
+      shutil.rmtree(os.path.join(final_submissions_dir, code_dirname), True)
+  if removed:
+    print "Removed final submissions of {} students no longer in {}".format(
+        len(removed), course_dir)
+  print "Preparing final submission directories of {} students ...".format(
+      len(students))
+  tasks = [(os.path.join(course_dir, student), final_submissions_dir,
+            args.extension, heads.get(student), args.git_reader) \
+           for student in students]
+  if args.jobs > 1:
+    pool = Pool(args.jobs)
+    try:
+      exported = pool.map(export_final_submission, tasks)
+    finally:
+      pool.terminate()
+      pool.join()
+  else:
+    exported = map(export_final_submission, tasks)
+
+  num_updated = 0
+  for student, head in zip(students, exported):
+    if head is None:
+      print "master: ignoring %s, corrupt git" % student
+      continue
+    if head != heads.get(student):
+      num_updated += 1
+    heads[student] = head
+  with open(heads_path, 'w') as f:
+    json.dump(heads, f)
+  print "Updated final submissions of {}/{} students".format(
+      num_updated, len(students))
+  return final_submissions_dir
+
+"""
+Writes the code files of a student's master commit into the final
+submissions layout, unless master is still the previously exported
+commit. Returns [master commit, code dirs], or None without a master.
+"""
+def export_final_submission(task):
+  student_dir, final_submissions_dir, extension, previous, git_reader = task
+  student = os.path.basename(os.path.normpath(student_dir))
+  student_newname = ''.join(student.split('_')) # remove underscores
+  reader = git_interface.open_reader(student_dir, git_reader)
+  try:
+    head = reader.resolve('master')
+    if not head:
+      return None
+    if previous and previous[0] == head and all(os.path.exists(
+        os.path.join(final_submissions_dir, d)) for d in previous[1]):
+      return previous
+    for code_dirname in (previous[1] if previous else []):
+      shutil.rmtree(os.path.join(final_submissions_dir, code_dirname), True)
+    code_dirnames = []
+    for code_fname, blob_hash in reader.list_files(head):
+      if not code_fname.endswith(extension): continue
       # remove all underscores
       code_newname = ''.join(code_fname.split('.')[0].split('_'))
       code_dirname = '%s_%s' % (student_newname, code_newname)
       code_dir = os.path.join(final_submissions_dir, code_dirname)
-      sys.stdout.write('{}/{}: {}/{} {}\r'.format(
-        i+1, len(course_dir), j+1, len(code_files),
-        os.path.join(code_dirname, code_fname)))
-      sys.stdout.flush()
+      if os.path.exists(code_dir):
+        shutil.rmtree(code_dir)
       os.mkdir(code_dir)
-      src = os.path.join(student_dir, code_fname)
-      dst = os.path.join(code_dir, code_fname)
-      shutil.move(src, dst)
-  sys.stdout.write('\n')
-  sys.stdout.flush()
-  return final_submissions_dir
+      with open(os.path.join(code_dir, code_fname), 'wb') as f:
+        f.write(reader.read_blob(blob_hash))
+      code_dirnames.append(code_dirname)
+    return [head, code_dirnames]
+  finally:
+    reader.close()
 
 ############################### Helper functions #############################
 def argmax_result(results):
@@ -86,15 +158,14 @@ def load_top_matches(course_dir, out_dir, fname=None):
   with open(top_matches_path, 'r') as f:
     return [Result.parse_line(line) for line in f.readlines()]
 
-def save_top_matches(top_matches, course_dir, args):
-  # first filter out for null matches.
-  top_matches = filter(lambda x: x, top_matches)
-
+"""
+Exports the top match of every student in the course's result store.
+"""
+def save_top_matches(course_dir, args):
   coursename = os.path.basename(os.path.normpath(course_dir))
   out_course_dir = os.path.join(args.out, coursename)
   top_matches_path = os.path.join(out_course_dir, TOP_MATCHES)
-  top_match_tuples = [top_match.get_tuple() for top_match in top_matches]
-  write_csv(top_matches_path, top_match_tuples)
+  get_result_store(course_dir, args.out).export_top_matches(top_matches_path)
 
 ################################### Cleanup ###################################
 def cleanup_student(student, args):
@@ -108,7 +179,7 @@ def cleanup_student(student, args):
 
 def cleanup(args):
   if os.path.exists(args.temp):
-    print "Removing temporary directory..."
+    print "Removing temporary directory {}...".format(args.temp)
     shutil.rmtree(args.temp)
 
 ################################# Algorithm 1 #################################
@@ -119,76 +190,380 @@ Input:
   online_dir: Path for online directory.
 
 Output:
-  nothing. Saves top matches to a file.
+  top matches, also saved to a file.
 """
 def tmoss(course_dir, args):
-  start_time = time.time()
-  top_matches = load_top_matches(course_dir, args.out)
-  if top_matches: # already processed
-    print "Already processed {}".format(course_dir)
-    return top_matches
-  
-  top_matches = get_top_matches(course_dir, args)
-  save_top_matches(top_matches, course_dir, args)
-  cleanup(args)   # course cleanup
-  end_time = time.time()
-  print "Runtime for {}: took {}".format(course_dir,
-        seconds_to_time(end_time - start_time))
-
-
-def get_top_matches(course_dir, args):
-  compare_set = get_compare_set(course_dir, args)
-  if args.multithread:
-    pool = ThreadPool(NUM_THREADS)
-    zipped_args = [(student_name, course_dir, compare_set, args) \
-        for student_name in sorted(os.listdir(course_dir))][14:15]
-    top_matches = pool.map(get_top_match, zipped_args)
-    top_matches = filter(lambda x: x, top_matches)
+  tmoss_all([course_dir], args)
+  return load_top_matches(course_dir, args.out)
+
+"""
+Runs TMOSS over many courses with one global task queue, so idle workers
+pick up the next course's tasks while the last ones of a course finish.
+Each course is saved and cleaned up as soon as all of its tasks are done.
+
+Re-runs are incremental: only commits added since a student's last run
+are scored, and merged into the student's existing top match.
+"""
+def tmoss_all(course_dirs, args):
+  courses = [CourseRun(course_dir, args) for course_dir in course_dirs]
+  tasks = [(i, j, task) for i, course in enumerate(courses) \
+      for j, task in enumerate(course.tasks)]
+
+  # workers fork after every course's compare set is ready
+  # and the report templates are compiled
+  pymoss.html.warm_up()
+  if args.jobs > 1:
+    pool = Pool(args.jobs)
+    task_results = pool.imap_unordered(run_task, tasks)
   else:
-    top_matches = []
-    for student_name in sorted(os.listdir(course_dir))[:3]:
-      zipped_arg = (student_name, course_dir, compare_set, args)
-      top_match = get_top_match(zipped_arg)
-      if not top_match:
-        print "{} was not a valid git repository.".format(student_name)
+    pool = None
+    task_results = run_tasks_prefetched(tasks)
+
+  try:
+    for course in courses:
+      if course.is_done():
+        course.finish()
+    for i, j, top_match in task_results:
+      courses[i].record(j, top_match)
+      if courses[i].is_done():
+        courses[i].finish()
+  except BaseException:
+    # don't leave git or MOSS running behind an interrupted run
+    pymoss.command.cancel()
+    raise
+  finally:
+    if pool:
+      pool.terminate()
+      pool.join()
+
+def run_task(indexed_task):
+  i, j, task = indexed_task
+  return i, j, get_top_match(task)
+
+"""
+Runs tasks one after another in this process, exporting the snapshots
+of the next student in a background thread while the current one is
+scored, so that extraction overlaps with backend runs.
+"""
+def run_tasks_prefetched(tasks):
+  prefetcher = ThreadPool(1)
+  setup = None # (task index, student, async setup_repository)
+  try:
+    for k, (i, j, task) in enumerate(tasks):
+      if setup and setup[0] == k:
+        student = setup[1]
+        setup[2].get()
+      else:
+        student = setup_task(task)
+        student.setup_repository(task[4], task[5])
+      setup = None
+      # parts of one student share its snapshot repository
+      if k + 1 < len(tasks) and tasks[k+1][2][0] != task[0]:
+        next_task = tasks[k+1][2]
+        next_student = setup_task(next_task)
+        setup = (k + 1, next_student, prefetcher.apply_async(
+            next_student.setup_repository, (next_task[4], next_task[5])))
+      yield i, j, get_top_match(task, student)
+  finally:
+    prefetcher.close()
+    prefetcher.join()
+
+"""
+Tasks and partial results of one course.
+"""
+class CourseRun(object):
+  def __init__(self, course_dir, args):
+    self.start_time = time.time()
+    self.course_dir = course_dir
+    self.args = get_course_args(course_dir, args)
+    compare_set = get_compare_set(course_dir, self.args)
+    self.top_matches, self.tasks, self.heads, self.duplicates = \
+        get_student_tasks(course_dir, compare_set, self.args)
+    if self.tasks:
+      prepare_compare_set(compare_set, self.args)
+    self.parts_left, self.part_matches = {}, {}
+    for student_name, _, _, _, _, _ in self.tasks:
+      self.parts_left[student_name] = self.parts_left.get(student_name, 0) + 1
+    self.num_done = 0
+
+  def record(self, j, top_match):
+    student_name = self.tasks[j][0]
+    self.num_done += 1
+    print "Course {}: task {}/{} done ({})".format(
+      self.course_dir, self.num_done, len(self.tasks), student_name)
+    if top_match:
+      self.part_matches.setdefault(student_name, []).append(top_match)
+    self.parts_left[student_name] -= 1
+    if self.parts_left[student_name] > 0:
+      return
+    student = Student(student_name, self.course_dir, self.args)
+    duplicates = self.duplicates.pop(student_name, [])
+    if duplicates:
+      num_recorded = student.record_duplicate_snapshots(duplicates)
+      for _ in range(num_recorded):
+        course_saved[self.course_dir].incr_and_get()
+      for _ in range(len(duplicates) - num_recorded):
+        course_skipped[self.course_dir].incr_and_get()
+    if student_name in self.part_matches:
+      # merged with the top match of earlier runs;
+      # earliest snapshot wins ties, as within a single task
+      part_matches = self.part_matches.pop(student_name)
+      if student_name in self.top_matches:
+        part_matches.append(self.top_matches[student_name])
+      top_match = argmax_result(sorted(part_matches,
+        key=lambda result: result.get_snapshot()))
+      student.save_top_match(top_match)
+      self.top_matches[student_name] = top_match
+      # once all parts are stored, so chunks don't render the same reports
+      if self.args.html_top > 0:
+        student.write_reports(self.args.html_top)
+    student.set_last_commit(self.heads[student_name])
+
+  def is_done(self):
+    return self.num_done == len(self.tasks)
+
+  def finish(self):
+    save_top_matches(self.course_dir, self.args)
+    cleanup(self.args)   # course cleanup
+    end_time = time.time()
+    print "Runtime for {}: took {}".format(self.course_dir,
+          seconds_to_time(end_time - self.start_time))
+    print "Backend runs for {}: {} run, {} saved by identical snapshots".format(
+          self.course_dir, course_runs[self.course_dir].get(),
+          course_saved[self.course_dir].get())
+    if self.args.sample_delta > 0:
+      print "Snapshots skipped by sampling for {}: {}".format(
+          self.course_dir, course_skipped[self.course_dir].get())
+
+"""
+Returns (top matches of earlier runs, tasks for the new commits,
+HEAD commit of each student, duplicate snapshots of each student).
+
+A task scores a part of one student's new snapshots, and is labeled with
+the student's position in the course for progress output. With more than one
+job, long histories are split into parts of --chunk-size snapshots, so one
+student does not hold up the whole course. Snapshots skipped by the
+sampling of earlier runs are scored again along with new commits, or
+when sampling is off.
+
+Commits with identical code are scored once, in the oldest one, even if
+they would fall into different parts. The others are returned as
+(snapshot, original snapshot) pairs, to be recorded once all of the
+student's parts are done (see Student.record_duplicate_snapshots).
+"""
+def get_student_tasks(course_dir, compare_set, args):
+  top_matches, tasks, heads, duplicates = {}, [], {}, {}
+  student_names = [student_name for student_name in sorted(os.listdir(course_dir)) \
+      if os.path.isdir(os.path.join(course_dir, student_name))]
+  for student_i, student_name in enumerate(student_names, 1):
+    label = "Student {}/{} {}".format(student_i, len(student_names),
+        student_name)
+    student = Student(student_name, course_dir, args)
+    top_match = student.get_top_match()
+    if top_match:
+      top_matches[student_name] = top_match
+    head, commits = student.get_new_commits()
+    if not head:
+      print "{} was not a valid git repository.".format(label)
+      continue
+    heads[student_name] = head
+    if commits or args.sample_delta <= 0:
+      commits += [commit for commit in student.get_skipped_commits() \
+          if commit not in commits]
+    if not commits:
+      print "{} already processed".format(label)
+      continue
+    originals, unique = {}, []
+    snapshots = [git_interface.snapshot_name(student_name, commit) \
+        for commit in commits]
+    for snapshot, commit, key in sorted(zip(snapshots, commits,
+        student.get_commit_keys(commits))):
+      if key in originals:
+        duplicates.setdefault(student_name, []).append(
+            (snapshot, originals[key]))
         continue
-      top_matches.append(top_match)
-  return top_matches
-
-def get_top_match(zipped_arg):
-  student_name, course_dir, compare_set, args = zipped_arg
-  counter = course_counts[course_dir]
-  student = Student(student_name, course_dir, args)
-  student_i = counter.incr_and_get()
-  num_students = counter.get_total()
-
-  top_match = student.get_top_match()
-  if top_match:
-    print "Student {}/{} {} already processed".format(
-      student_i, num_students, student_name)
-    return top_match
-
-  ### setup
-  student.setup_repository()
-
-  ### for each snapshot, compute similarity
-  for j, snapshot_dir in enumerate(sorted(student.snapshots)):
-    print "Student {}/{} {} snapshot {}/{} ...".format(
-      student_i, num_students, student_name,
-      j+1, len(student.snapshots))
+      originals[key] = snapshot
+      unique.append(commit)
+    commits = unique[::-1] # newest first
+    chunk_size = len(commits)
+    if args.jobs > 1 and args.chunk_size > 0:
+      chunk_size = args.chunk_size
+    parts = [commits[j:j+chunk_size] \
+        for j in range(0, len(commits), chunk_size)]
+    for part, part_commits in enumerate(parts):
+      part_label = label
+      if len(parts) > 1:
+        part_label += " part {}/{}".format(part + 1, len(parts))
+      tasks.append((student_name, course_dir, compare_set, args,
+                    part_commits, part_label))
+  return top_matches, tasks, heads, duplicates
+
+"""
+Student of a task (see get_student_tasks), in the worker's temp workspace.
+"""
+def setup_task(task):
+  student_name, course_dir, compare_set, args, commits, label = task
+  return Student(student_name, course_dir, get_worker_args(args))
+
+"""
+Scores one task (see get_student_tasks) in its own temp workspace.
+student: the task's student with its snapshots already exported
+(see run_tasks_prefetched), or None to set it up here.
+Returns the top match among the task's snapshots, or None.
+"""
+def get_top_match(task, student=None):
+  student_name, course_dir, compare_set, args, commits, label = task
+  args = get_worker_args(args)
+  if not student:
+    ### setup
+    student = setup_task(task)
+    student.setup_repository(commits, label)
+
+  ### for each snapshot, load or compute similarity
+  snapshot_dirs = sorted(student.snapshots)
+  pending, duplicates = [], {} # content key -> duplicate snapshot dirs
+  for snapshot_dir in snapshot_dirs:
     result = student.load_match(snapshot_dir)
-    if not result:
-      results = compute_similarity(snapshot_dir, compare_set, student, args)
-      result = argmax_result(results)
-    student.record_match(result)
-    cleanup_similarity_workspace(snapshot_dir, args)
+    if result:
+      student.record_match(result)
+  pending_keys = set()
+  for snapshot_dir in snapshot_dirs:
+    if student.is_match_computed(snapshot_dir): continue
+    key = student.get_snapshot_key(snapshot_dir)
+    if student.load_duplicate(snapshot_dir) or \
+        (key is not None and key in pending_keys):
+      duplicates.setdefault(key, []).append(snapshot_dir)
+      continue
+    pending_keys.add(key)
+    pending.append(snapshot_dir)
+
+  if args.sample_delta > 0 and len(pending) > 2:
+    skipped = score_sampled(student, pending, compare_set, course_dir, args,
+        label)
+  else:
+    skipped = []
+    score_snapshots(student, pending, compare_set, course_dir, args, label)
+  for key, duplicate_dirs in duplicates.items():
+    if key in student.scored:
+      record_duplicates(student, duplicate_dirs, course_dir)
+    else: # only duplicates of skipped snapshots
+      skipped.extend(duplicate_dirs)
+  for snapshot_dir in skipped:
+    student.record_skipped(snapshot_dir)
+    course_skipped[course_dir].incr_and_get()
 
-  if not student.get_matches():
-    return None
-  top_match = argmax_result(student.get_matches())
-  student.save_top_match(top_match)
   ### cleanup
   student.cleanup()
 
-  return top_match
+  if not student.get_matches():
+    return None
+  return argmax_result(student.get_matches()).get_summary()
+
+"""
+Scores snapshots in backend runs of --batch-size snapshots each.
+Only the files changed since the student's earlier snapshots are sent
+to the backend; the others reuse their results (see Student.record_files).
+"""
+def score_snapshots(student, snapshot_dirs, compare_set, course_dir, args,
+    label):
+  batch_size = max(args.batch_size, 1)
+  for j in range(0, len(snapshot_dirs), batch_size):
+    batch = snapshot_dirs[j:j+batch_size]
+    print "{} snapshot {}-{}/{} ...".format(label,
+      j+1, j+len(batch), len(snapshot_dirs))
+    # each changed file is sent once, with the first snapshot that has it
+    skip, sent, run = {}, set(), []
+    for snapshot_dir in batch:
+      files = student.get_unscored_files(snapshot_dir) - sent
+      if not files: continue
+      sent.update(files)
+      snapshot = os.path.basename(os.path.normpath(snapshot_dir))
+      skip[snapshot] = student.get_other_code_dirs(snapshot_dir, files)
+      run.append(snapshot_dir)
+    results = {}
+    if run:
+      results = compute_similarity_batch(
+        [(snapshot_dir, student) for snapshot_dir in run], compare_set, args,
+        skip)
+      course_runs[course_dir].incr_and_get()
+    for snapshot_dir in batch:
+      snapshot = os.path.basename(os.path.normpath(snapshot_dir))
+      student.record_files(snapshot_dir, results.get(snapshot, []))
+    if run:
+      cleanup_similarity_workspace(run[0], args)
 
+"""
+Diff-aware sampling of a student's snapshots (--sample-delta), oldest first.
+
+Scores the first and last snapshots, and each one whose code changed by at
+least --sample-delta lines since the last one picked. Then the skipped
+snapshots next to every local peak of the scores are scored densely, and
+again next to the best snapshot until all of its neighbors are scored, so
+the student's maximum is exact around the peaks. Peaks are found among
+the scores of earlier runs too, so that their skipped snapshots are
+filled in next to a new peak; on a plateau, the earliest snapshot is
+the peak.
+Returns the snapshots that were never scored.
+"""
+def score_sampled(student, pending, compare_set, course_dir, args, label):
+  picked = [0]
+  for k in range(1, len(pending)):
+    if k == len(pending) - 1 or student.get_snapshot_delta(
+        pending[picked[-1]], pending[k]) >= args.sample_delta:
+      picked.append(k)
+  score_snapshots(student, [pending[k] for k in picked], compare_set,
+      course_dir, args, label + " sampled")
+
+  # snapshot names, oldest first, with the snapshots of earlier runs
+  snapshot_dirs = dict((os.path.basename(os.path.normpath(snapshot_dir)),
+      snapshot_dir) for snapshot_dir in pending)
+  timeline = sorted(set(snapshot_dirs) | set(student.get_stored()))
+  result = lambda k: student.get_match(timeline[k]) or \
+      student.get_stored().get(timeline[k])
+  scored = set(k for k in range(len(timeline)) if result(k))
+  # earliest snapshot wins ties
+  rank = lambda k: (result(k).get_score(), -k)
+  best = lambda: max(scored, key=rank)
+  order = sorted(scored)
+  peaks = set(k for j, k in enumerate(order) \
+      if all(rank(k) > rank(order[i]) for i in (j - 1, j + 1) \
+          if 0 <= i < len(order)))
+  peaks.add(best())
+  while True:
+    fill = set()
+    for k in peaks:
+      # skipped snapshots between the peak and its scored neighbors
+      before = k - 1
+      while before >= 0 and before not in scored: before -= 1
+      after = k + 1
+      while after < len(timeline) and after not in scored: after += 1
+      fill.update(range(before + 1, k) + range(k + 1, after))
+    if not fill:
+      break
+    score_snapshots(student, [snapshot_dirs[timeline[k]] for k in sorted(fill)],
+        compare_set, course_dir, args, label + " around peaks")
+    scored |= fill
+    peaks = [best()]
+  return [snapshot_dirs[timeline[k]] for k in range(len(timeline)) \
+      if k not in scored]
+
+def record_duplicates(student, snapshot_dirs, course_dir):
+  for snapshot_dir in snapshot_dirs:
+    student.record_duplicate(snapshot_dir)
+    course_saved[course_dir].incr_and_get()
+
+################################### Reports ###################################
+"""
+Renders reports on demand from the result store: the top match of each
+of the given students, in every course where they have one.
+"""
+def write_reports(course_dirs, student_names, args):
+  for course_dir in course_dirs:
+    store = get_result_store(course_dir, args.out)
+    for student_name in student_names:
+      top_match = store.get_top_match(student_name)
+      if not top_match: continue
+      student = Student(student_name, course_dir, args)
+      if not student.write_report(top_match.get_snapshot()):
+        print "{}: no report stored for {}".format(course_dir,
+          top_match.get_snapshot())
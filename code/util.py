@@ -1,21 +1,30 @@
 import os, sys, subprocess
+import json
 import shutil
 import re
 import itertools
+import copy
 import pytz
 
 import datetime, time
-from multiprocessing import Pool as ThreadPool
-from multiprocessing import Lock, Value
+from multiprocessing import Pool, Lock, Value, cpu_count
+from pymoss import command
 ########################## Constants ######################
 TEMP_REPO_DIR = 'repo'
 TOP_MATCHES = 'top_matches.csv'
-NUM_THREADS = 8 # if multiprocessing is turned on
+WORKER_DIR = 'worker'
+STATIC_DIR = 'static'
+FINAL_HEADS = '.heads.json'
 pst = pytz.timezone('US/Pacific')
 utc = pytz.utc
 
-def call_cmd(cmd):
-  return subprocess.Popen([cmd],stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True).communicate()
+"""
+Runs a shell command line, returning (stdout, stderr).
+Goes through pymoss.command, so concurrent commands of a kind are
+bounded and time out (see pymoss.config.COMMAND_LIMITS/TIMEOUTS).
+"""
+def call_cmd(cmd, kind='git'):
+  return command.run(kind, cmd, shell=True)[1:]
 
 def seconds_to_time(seconds):
   dec = ("%.4f" % (seconds % 1)).lstrip('0')
@@ -28,13 +37,18 @@ def posix_to_datetime(posix_t, format_str=None):
     format_str = '%m/%d %H:%M'
   return utc.localize(datetime.datetime.fromtimestamp(posix_t)).astimezone(pst).strftime(format_str)
 
-course_counts = {}
+course_runs = {}  # backend runs per course
+course_saved = {} # backend runs skipped via snapshot content keys
+course_skipped = {} # snapshots never scored (see --sample-delta)
 def set_global_course_counts(course_dirs):
-  course_counts.update(dict([(course_dir,
-                        LockedCounter(len(os.listdir(course_dir)))) \
+  course_runs.update(dict([(course_dir, LockedCounter()) \
+                        for course_dir in course_dirs]))
+  course_saved.update(dict([(course_dir, LockedCounter()) \
+                        for course_dir in course_dirs]))
+  course_skipped.update(dict([(course_dir, LockedCounter()) \
                         for course_dir in course_dirs]))
 class LockedCounter(object):
-  def __init__(self, total):
+  def __init__(self, total=0):
     self.lock = Lock()
     self.count = Value('i', 0)
     self.total = total
@@ -51,6 +65,26 @@ class LockedCounter(object):
   def get_total(self):
     return self.total
 
+"""
+Copy of args with a temp workspace of its own for one course,
+so that courses running side by side can be cleaned up separately.
+"""
+def get_course_args(course_dir, args):
+  course_args = copy.copy(args)
+  course_args.temp = os.path.join(args.temp,
+      os.path.basename(os.path.normpath(course_dir)))
+  return course_args
+
+"""
+Copy of args for the current process, with its own temp workspace
+so that parallel workers never share args.temp.
+"""
+def get_worker_args(args):
+  worker_args = copy.copy(args)
+  worker_args.temp = os.path.join(args.temp,
+      '%s_%d' % (WORKER_DIR, os.getpid()))
+  return worker_args
+
 def write_csv(fpath, tuple_list):
   with open(fpath, 'w') as f:
     f.write('\n'.join([','.join(map(str, item)) for item in tuple_list]))
@@ -58,21 +92,14 @@ def write_csv(fpath, tuple_list):
 
 
 class Result(object):
+  __slots__ = ('student', 'snapshot', 'score', 'other')
+
   @staticmethod
   def parse_line(line):
     tup = line.strip().split(',')
     student, other, snapshot, score = tup
     return Result(student, snapshot, float(score), other)
 
-  @staticmethod
-  def load_csv(out_dir, snapshot):
-    fdest = os.path.join(out_dir, "{}.csv".format(snapshot))
-    if not os.path.exists(fdest):
-      return None
-    with open(fdest, 'r') as f:
-      student, other, snapshot, score = Result.parse_line(f.readline()).get_tuple()
-      return Result(student, snapshot, score, other)
-
   def __init__(self, student, snapshot, score=0, other=None):
     self.student = student
     self.snapshot = snapshot
@@ -97,14 +124,31 @@ class Result(object):
     return (self.get_student(), self.get_other(),
         self.get_snapshot(), self.get_score())
 
-  def write_csv(self, out_dir):
-    fdest = os.path.join(out_dir, "{}.csv".format(self.get_snapshot()))
-    if os.path.exists(fdest):
-      return fdest
-    if not os.path.exists(out_dir):
-      os.makedirs(out_dir)
-    write_csv(fdest, [self.get_tuple()])
-    return fdest
-
-  def write_html(self, out_dir):
-    pass
+  """
+  Plain Result with just the summary fields (cheap to pass between processes).
+  """
+  def get_summary(self):
+    return Result(self.student, self.snapshot, self.score, self.other)
+
+  """
+  Copy of this result recorded under another snapshot name,
+  for snapshots whose code is identical to this one.
+  """
+  def for_snapshot(self, snapshot):
+    result = copy.copy(self)
+    result.snapshot = snapshot
+    return result
+
+  """
+  Data to render this result's report later (see moss_interface.write_report).
+  None if there is nothing to report.
+  """
+  def get_report(self):
+    return None
+
+  """
+  Code dir of the snapshot file this result was scored on, or None
+  if the result is not from a single file (see Student.record_files).
+  """
+  def get_file(self):
+    return None